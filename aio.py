@@ -0,0 +1,162 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Coroutine versions of the Geoname lookups, for asyncio services which
+# can't block on Django's connection. It talks to PostgreSQL through a
+# bounded asyncpg pool and doesn't import Django (it needs Python 3.5+):
+# rows are returned as dicts with the columns of the geoname table.
+#
+#     geonames = await AsyncGeonames.connect('postgresql://localhost/geonames')
+#     places = await geonames.near_point(40.41, -3.70, kms=10)
+#
+# Identical lookups running at the same time share a single query, so
+# the rows returned must be treated as read-only.
+
+import asyncio
+
+import asyncpg
+
+NEAR_POINT_EXCLUDED_FCODES = ('PCLI', 'PCL', 'PCLD', 'CONT')
+
+GEONAME_FIELDS = ('id', 'name', 'ascii_name', 'latitude', 'longitude', 'fclass', 'fcode',
+    'country_id', 'cc2', 'admin1_id', 'admin2_id', 'admin3_id', 'admin4_id', 'population',
+    'elevation', 'gtopo30', 'timezone_id', 'moddate')
+
+DEFAULT_POOL_SIZE = 10
+
+def select_fields(table):
+    return ', '.join(['%s.%s' % (table, f) for f in GEONAME_FIELDS])
+
+NEAR_POINT_SQL = '''SELECT %(fields)s, ST_Distance(p.point, g.gpoint_meters) AS distance
+FROM geoname g, (SELECT ST_Transform(ST_SetSRID(ST_MakePoint($2, $1), 4326), 32661) AS point) p
+WHERE g.fcode <> ALL($3) AND ST_DWithin(p.point, g.gpoint_meters, $4)%(order)s'''
+
+BOX_TZ_SQL = '''SELECT timezone_id FROM geoname
+WHERE ST_Within(gpoint, ST_SetSRID(ST_MakeBox2D(ST_MakePoint($3, $1), ST_MakePoint($4, $2)), 4326))
+    AND timezone_id IS NOT NULL LIMIT 1'''
+
+HIERARCHY_SQL = '''SELECT %s FROM geoname_ancestor a JOIN geoname g ON g.id = a.ancestor_id
+WHERE a.geoname_id = $1 ORDER BY a.depth''' % select_fields('g')
+
+I18N_NAMES_SQL = '''SELECT geoname_id, name FROM geoname_i18n_name
+WHERE language = $1 AND geoname_id = ANY($2)'''
+
+ALTERNATE_NAMES_SQL = '''SELECT DISTINCT ON (geoname_id) geoname_id, name FROM alternate_name
+WHERE language = $1 AND geoname_id = ANY($2) ORDER BY geoname_id, preferred DESC, id'''
+
+class Coalescer(object):
+    def __init__(self):
+        self.pending = {}
+
+    async def run(self, key, factory):
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.pending[key] = future
+            def done(f):
+                if self.pending.get(key) is f:
+                    del self.pending[key]
+            future.add_done_callback(done)
+        # A cancelled caller must not cancel the lookup the others wait on
+        return await asyncio.shield(future)
+
+class AsyncGeonames(object):
+    def __init__(self, pool, i18n_languages=(), tz_grid=None):
+        self.pool = pool
+        self.i18n_languages = frozenset(i18n_languages)
+        self.tz_grid = tz_grid
+        self.coalescer = Coalescer()
+        self.timezones = None
+
+    @classmethod
+    async def connect(cls, dsn, pool_size=DEFAULT_POOL_SIZE, i18n_languages=(), tz_grid=None,
+            **kwargs):
+        # i18n_languages are the ones built by the importer (see
+        # models.i18n_name_languages), tz_grid a spatial.TimezoneGrid
+        pool = await asyncpg.create_pool(dsn, min_size=1, max_size=pool_size, **kwargs)
+        return cls(pool, i18n_languages, tz_grid)
+
+    async def close(self):
+        await self.pool.close()
+
+    async def fetch(self, sql, *args):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def get_many(self, geoname_ids):
+        geoname_ids = sorted(set(int(x) for x in geoname_ids))
+        async def lookup():
+            rows = await self.fetch('SELECT %s FROM geoname g WHERE g.id = ANY($1)' % \
+                select_fields('g'), geoname_ids)
+            return dict((row['id'], dict(row)) for row in rows)
+        return await self.coalescer.run(('get_many', tuple(geoname_ids)), lookup)
+
+    async def get(self, geoname_id):
+        return (await self.get_many([geoname_id])).get(int(geoname_id))
+
+    async def near_point(self, latitude, longitude, kms=20, order=True):
+        # [(row, distance in meters)], like Geoname.near_point
+        latitude, longitude, kms = float(latitude), float(longitude), float(kms)
+        async def lookup():
+            rows = await self.fetch(NEAR_POINT_SQL % {
+                    'fields': select_fields('g'),
+                    'order': order and ' ORDER BY distance' or '',
+                }, latitude, longitude, list(NEAR_POINT_EXCLUDED_FCODES), kms * 1000)
+            return [(dict((f, row[f]) for f in GEONAME_FIELDS), row['distance']) for row in rows]
+        return await self.coalescer.run(('near_point', latitude, longitude, kms, order), lookup)
+
+    async def load_timezones(self):
+        async def lookup():
+            rows = await self.fetch('SELECT id, name, gmt_offset, dst_offset FROM time_zone')
+            return dict((row['id'], dict(row)) for row in rows)
+        if self.timezones is None:
+            self.timezones = await self.coalescer.run(('timezones',), lookup)
+        return self.timezones
+
+    async def aprox_tz(self, latitude, longitude):
+        # Same search as GeonameGISHelper.aprox_tz
+        timezones = await self.load_timezones()
+        flat, flng = float(latitude), float(longitude)
+        if self.tz_grid is not None:
+            return timezones.get(self.tz_grid.lookup(flat, flng))
+
+        async def lookup():
+            async with self.pool.acquire() as conn:
+                for diff in (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1):
+                    timezone_id = await conn.fetchval(BOX_TZ_SQL, flat - diff * 10,
+                        flat + diff * 10, flng - diff, flng + diff)
+                    if timezone_id is not None:
+                        return timezones.get(timezone_id)
+            return None
+        return await self.coalescer.run(('aprox_tz', flat, flng), lookup)
+
+    async def translate_many(self, geoname_ids, lang):
+        # {geoname id: name}, falling back to the geoname name
+        geoname_ids = sorted(set(int(x) for x in geoname_ids))
+        async def lookup():
+            sql = lang in self.i18n_languages and I18N_NAMES_SQL or ALTERNATE_NAMES_SQL
+            names = dict((row[0], row[1]) for row in await self.fetch(sql, lang, geoname_ids))
+            missing = [x for x in geoname_ids if x not in names]
+            if missing:
+                rows = await self.fetch('SELECT id, name FROM geoname WHERE id = ANY($1)', missing)
+                names.update((row[0], row[1]) for row in rows)
+            return names
+        return await self.coalescer.run(('translate', lang, tuple(geoname_ids)), lookup)
+
+    async def translate(self, geoname_id, lang):
+        return (await self.translate_many([geoname_id], lang)).get(int(geoname_id))
+
+    async def hierarchy(self, geoname_id):
+        # Ancestors from the parent up, needs the geoname_ancestor table
+        # built by the importer
+        geoname_id = int(geoname_id)
+        async def lookup():
+            return [dict(row) for row in await self.fetch(HIERARCHY_SQL, geoname_id)]
+        return await self.coalescer.run(('hierarchy', geoname_id), lookup)
+
+    async def query(self, q, index, max_count=10):
+        # index is a search.NameIndex, like the one Geoname.query uses
+        ids = index.search(q, max_count)
+        rows = await self.get_many(ids)
+        return [rows[x] for x in ids if x in rows]
@@ -0,0 +1,238 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Maintenance of the denormalized tables derived from the geonames data.
+# Everything here works on a plain DB-API cursor, so it's shared by the
+# importer (which has its own psycopg2 connection) and geonames-update.
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ID_CHUNK_SIZE = 10000
+
+# How the database was imported (the languages in geoname_i18n_name...),
+# read back by the models and geonames-update
+IMPORT_SETTINGS_TABLE = 'geonames_import_setting'
+
+GLOBE_GEONAME_ID = 6295630
+
+# Guards against cycles in broken data, real hierarchies are much shorter
+MAX_ANCESTOR_DEPTH = 16
+
+# Mirrors Geoname.get_parent: the candidates are tried from the most to
+# the least specific one, skipping those above the geoname's own level
+# and those pointing back to the geoname itself.
+PARENTS_SQL = '''INSERT INTO geoname_ancestor (geoname_id, ancestor_id, depth)
+SELECT id, parent_id, 1 FROM (
+    SELECT g.id, CASE
+        WHEN g.id = %(globe)d THEN NULL
+        WHEN g.fcode = 'CONT' THEN %(globe)d
+        ELSE COALESCE(
+            CASE WHEN g.level >= 6 AND a4.geoname_id <> g.id THEN a4.geoname_id END,
+            CASE WHEN g.level >= 5 AND a3.geoname_id <> g.id THEN a3.geoname_id END,
+            CASE WHEN g.level >= 4 AND a2.geoname_id <> g.id THEN a2.geoname_id END,
+            CASE WHEN g.level >= 3 AND a1.geoname_id <> g.id THEN a1.geoname_id END,
+            CASE WHEN g.level >= 2 AND c.geoname_id <> g.id THEN c.geoname_id END,
+            CASE WHEN ct.geoname_id <> g.id THEN ct.geoname_id END)
+        END AS parent_id
+    FROM (SELECT id, fcode, country_id, admin1_id, admin2_id, admin3_id, admin4_id,
+            CASE
+                WHEN SUBSTR(fcode, 1, 3) = 'PCL' THEN 1
+                WHEN fcode IN ('ADM1', 'ADMD') THEN 2
+                WHEN fcode = 'ADM2' THEN 3
+                WHEN fcode = 'ADM3' THEN 4
+                WHEN fcode = 'ADM4' THEN 5
+                ELSE 6
+            END AS level
+        FROM geoname%(where)s) g
+    LEFT JOIN admin4_code a4 ON a4.id = g.admin4_id
+    LEFT JOIN admin3_code a3 ON a3.id = g.admin3_id
+    LEFT JOIN admin2_code a2 ON a2.id = g.admin2_id
+    LEFT JOIN admin1_code a1 ON a1.id = g.admin1_id
+    LEFT JOIN country c ON c.iso_alpha2 = g.country_id
+    LEFT JOIN continent ct ON ct.code = c.continent_id
+) parents WHERE parent_id IS NOT NULL'''
+
+EXTEND_ANCESTORS_SQL = 'INSERT INTO geoname_ancestor (geoname_id, ancestor_id, depth) ' \
+    'SELECT a.geoname_id, p.ancestor_id, a.depth + 1 FROM geoname_ancestor a ' \
+    'JOIN geoname_ancestor p ON p.geoname_id = a.ancestor_id AND p.depth = 1 ' \
+    'WHERE a.depth = %s AND p.ancestor_id <> a.geoname_id'
+
+# Mirrors Geoname.get_children: every candidate child gets the rank of
+# the group it belongs to and only the best ranked (first non-empty)
+# group of each parent is kept, numbered in name order.
+CHILD_RANK_SQL = '''CASE %s ELSE NULL END'''
+
+CHILDREN_SQL = '''INSERT INTO geoname_child (parent_id, child_id, position)
+SELECT parent_id, child_id, ROW_NUMBER() OVER (PARTITION BY parent_id ORDER BY name, child_id)
+FROM (
+    SELECT c.parent_id, c.child_id, c.name, c.rank,
+        MIN(c.rank) OVER (PARTITION BY c.parent_id) AS best
+    FROM (
+        SELECT %(globe)d AS parent_id, g.id AS child_id, g.name, 0 AS rank
+            FROM continent ct JOIN geoname g ON g.id = ct.geoname_id
+        UNION ALL
+        SELECT p.id, g.id, g.name, 0 FROM geoname p
+            JOIN continent ct ON ct.geoname_id = p.id
+            JOIN country c ON c.continent_id = ct.code
+            JOIN geoname g ON g.id = c.geoname_id
+            WHERE p.fcode = 'CONT'
+        UNION ALL
+        SELECT p.id, g.id, g.name, %(country_rank)s FROM geoname p
+            JOIN geoname g ON g.country_id = p.country_id
+            WHERE p.fclass = 'A' AND SUBSTR(p.fcode, 1, 3) = 'PCL'
+        UNION ALL
+        SELECT p.id, g.id, g.name, %(admin1_rank)s FROM geoname p
+            JOIN geoname g ON g.admin1_id = p.admin1_id
+            WHERE p.fclass = 'A' AND p.fcode = 'ADM1'
+        UNION ALL
+        SELECT p.id, g.id, g.name, %(admin2_rank)s FROM geoname p
+            JOIN geoname g ON g.admin2_id = p.admin2_id
+            WHERE p.fclass = 'A' AND p.fcode = 'ADM2'
+        UNION ALL
+        SELECT p.id, g.id, g.name, %(admin3_rank)s FROM geoname p
+            JOIN geoname g ON g.admin3_id = p.admin3_id
+            WHERE p.fclass = 'A' AND p.fcode = 'ADM3'
+        UNION ALL
+        SELECT p.id, g.id, g.name, %(admin4_rank)s FROM geoname p
+            JOIN geoname g ON g.admin4_id = p.admin4_id
+            WHERE p.fclass = 'A' AND p.fcode = 'ADM4'
+    ) c WHERE c.rank IS NOT NULL%(where)s
+) r WHERE rank = best'''
+
+def child_rank(fcodes):
+    whens = ["WHEN g.fcode = '%s' THEN %d" % (fcode, i + 1) for i, fcode in enumerate(fcodes)]
+    whens.append("WHEN g.fclass = 'P' THEN %d" % (len(fcodes) + 1))
+    return CHILD_RANK_SQL % ' '.join(whens)
+
+def children_sql(where=''):
+    return CHILDREN_SQL % {
+        'globe': GLOBE_GEONAME_ID,
+        'country_rank': child_rank(('ADM1', 'ADMD', 'ADM2', 'ADM3', 'ADM4')),
+        'admin1_rank': child_rank(('ADM2', 'ADM3', 'ADM4')),
+        'admin2_rank': child_rank(('ADM3', 'ADM4')),
+        'admin3_rank': child_rank(('ADM4',)),
+        'admin4_rank': child_rank(()),
+        'where': where,
+    }
+
+def id_chunks(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), ID_CHUNK_SIZE):
+        yield ids[i:i + ID_CHUNK_SIZE]
+
+def i18n_languages(settings):
+    try:
+        return list(settings.GEONAMES_I18N_LANGUAGES)
+    except AttributeError:
+        return []
+
+def save_import_setting(cursor, name, value):
+    cursor.execute('CREATE TABLE IF NOT EXISTS %s (name VARCHAR(32) PRIMARY KEY, ' \
+        'value TEXT NOT NULL)' % IMPORT_SETTINGS_TABLE)
+    data = json.dumps(value)
+    cursor.execute('UPDATE %s SET value = %%s WHERE name = %%s' % IMPORT_SETTINGS_TABLE,
+        (data, name))
+    if cursor.rowcount == 0:
+        cursor.execute('INSERT INTO %s (name, value) VALUES (%%s, %%s)' % IMPORT_SETTINGS_TABLE,
+            (name, data))
+
+def import_setting(cursor, name, default=None):
+    cursor.execute('SELECT value FROM %s WHERE name = %%s' % IMPORT_SETTINGS_TABLE, (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return default
+    return json.loads(row[0])
+
+def refresh_i18n_names(cursor, languages, geoname_ids=None):
+    select = 'INSERT INTO geoname_i18n_name (geoname_id, language, name) ' \
+        'SELECT DISTINCT ON (geoname_id, language) geoname_id, language, name ' \
+        'FROM alternate_name WHERE language = ANY(%s)%s ' \
+        'ORDER BY geoname_id, language, preferred DESC, id'
+    if geoname_ids is None:
+        cursor.execute('DELETE FROM geoname_i18n_name')
+        cursor.execute(select % ('%s', ''), (list(languages),))
+        return
+
+    for chunk in id_chunks(geoname_ids):
+        cursor.execute('DELETE FROM geoname_i18n_name WHERE geoname_id = ANY(%s)', (chunk,))
+        cursor.execute(select % ('%s', ' AND geoname_id = ANY(%s)'), (list(languages), chunk))
+
+def insert_parents(cursor, geoname_ids=None):
+    if geoname_ids is None:
+        cursor.execute(PARENTS_SQL % { 'globe': GLOBE_GEONAME_ID, 'where': '' })
+        return
+    for chunk in id_chunks(geoname_ids):
+        cursor.execute(PARENTS_SQL % { 'globe': GLOBE_GEONAME_ID, 'where': ' WHERE id = ANY(%s)' },
+            (chunk,))
+
+def extend_ancestors(cursor, geoname_ids=None):
+    for depth in range(1, MAX_ANCESTOR_DEPTH):
+        inserted = 0
+        if geoname_ids is None:
+            cursor.execute(EXTEND_ANCESTORS_SQL, (depth,))
+            inserted += cursor.rowcount
+        else:
+            for chunk in id_chunks(geoname_ids):
+                cursor.execute(EXTEND_ANCESTORS_SQL + ' AND a.geoname_id = ANY(%s)', (depth, chunk))
+                inserted += cursor.rowcount
+        if not inserted:
+            break
+
+def parent_ids(cursor, geoname_ids):
+    cursor.execute('SELECT geoname_id, ancestor_id FROM geoname_ancestor ' \
+        'WHERE depth = 1 AND geoname_id = ANY(%s)', (list(geoname_ids),))
+    return dict(cursor.fetchall())
+
+def ancestor_ids(cursor, geoname_ids):
+    ancestors = set()
+    for chunk in id_chunks(geoname_ids):
+        cursor.execute('SELECT DISTINCT ancestor_id FROM geoname_ancestor ' \
+            'WHERE geoname_id = ANY(%s)', (chunk,))
+        ancestors.update([row[0] for row in cursor.fetchall()])
+    return ancestors
+
+def descendant_ids(cursor, geoname_ids):
+    descendants = set()
+    for chunk in id_chunks(geoname_ids):
+        cursor.execute('SELECT DISTINCT geoname_id FROM geoname_ancestor ' \
+            'WHERE ancestor_id = ANY(%s)', (chunk,))
+        descendants.update([row[0] for row in cursor.fetchall()])
+    return descendants
+
+def refresh_ancestors(cursor, geoname_ids=None):
+    if geoname_ids is None:
+        cursor.execute('DELETE FROM geoname_ancestor')
+        insert_parents(cursor)
+        extend_ancestors(cursor)
+        return
+
+    # Only geonames whose parent changed invalidate the paths of their
+    # descendants, everything else just gets its own path rebuilt
+    rebuild = set()
+    for chunk in id_chunks(geoname_ids):
+        old_parents = parent_ids(cursor, chunk)
+        cursor.execute('DELETE FROM geoname_ancestor WHERE geoname_id = ANY(%s)', (chunk,))
+        insert_parents(cursor, chunk)
+        new_parents = parent_ids(cursor, chunk)
+        changed = [i for i in chunk if old_parents.get(i) != new_parents.get(i)]
+        rebuild.update(chunk)
+        if changed:
+            rebuild.update(descendant_ids(cursor, changed))
+
+    for chunk in id_chunks(rebuild):
+        cursor.execute('DELETE FROM geoname_ancestor WHERE depth > 1 AND geoname_id = ANY(%s)', (chunk,))
+    extend_ancestors(cursor, rebuild)
+
+def refresh_children(cursor, parent_ids=None):
+    if parent_ids is None:
+        cursor.execute('DELETE FROM geoname_child')
+        cursor.execute(children_sql())
+        return
+
+    for chunk in id_chunks(parent_ids):
+        cursor.execute('DELETE FROM geoname_child WHERE parent_id = ANY(%s)', (chunk,))
+        cursor.execute(children_sql(' AND c.parent_id = ANY(%s)'), (chunk,))
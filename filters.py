@@ -0,0 +1,109 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Loads only part of the dump. Filters are set in GEONAMES_FILTERS, e.g.
+#
+#     GEONAMES_FILTERS = {
+#         'countries': ('ES', 'FR', 'PT'),
+#         'fclasses': ('A', 'P'),
+#         'min_population': 1000,
+#         'languages': ('en', 'es', 'fr', 'pt', 'ca'),
+#     }
+#
+# or given to geonames-import, which records the ones it applied for
+# geonames-update to apply them again. Some geonames
+# are kept whatever the filters say, since other rows point to them: the
+# globe, the continents, the countries and the administrative divisions
+# of the selected countries.
+
+FILTER_KEYS = ('countries', 'fclasses', 'fcodes', 'min_population', 'languages')
+
+ADMIN_FCODES = ('ADM1', 'ADM2', 'ADM3', 'ADM4')
+
+class GeonameFilter(object):
+    def __init__(self, countries=None, fclasses=None, fcodes=None, min_population=None,
+            languages=None):
+        self.countries = countries and frozenset(countries) or None
+        self.fclasses = fclasses and frozenset(fclasses) or None
+        self.fcodes = fcodes and frozenset(fcodes) or None
+        self.min_population = min_population or None
+        self.languages = languages and frozenset(languages) or None
+
+    @classmethod
+    def from_settings(cls, settings, **overrides):
+        # Overrides which are None keep the value from the settings
+        filters = dict(getattr(settings, 'GEONAMES_FILTERS', {}))
+        for key in filters:
+            if key not in FILTER_KEYS:
+                raise ValueError('Unknown key in GEONAMES_FILTERS: "%s"' % key)
+        for key, value in overrides.items():
+            if value is not None:
+                filters[key] = value
+        return cls(**filters)
+
+    @classmethod
+    def from_dict(cls, values):
+        # The other way around of as_dict, keys may come back as unicode
+        return cls(**dict([(str(key), value) for key, value in values.items()]))
+
+    def as_dict(self):
+        values = {}
+        for key in FILTER_KEYS:
+            value = getattr(self, key)
+            if isinstance(value, frozenset):
+                value = sorted(value)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def filters_geonames(self):
+        return bool(self.countries or self.fclasses or self.fcodes or self.min_population)
+
+    def filters_alternate_names(self):
+        return bool(self.languages)
+
+    def __nonzero__(self):
+        return self.filters_geonames() or self.filters_alternate_names()
+
+    def keep_country(self, country_id):
+        return self.countries is None or country_id.strip() in self.countries
+
+    def keep_geoname(self, record):
+        # record is a parsed dump line (see staging.parse_geoname)
+        if not self.keep_country(record[7]):
+            return False
+        if record[6] in ADMIN_FCODES:
+            return True
+        if self.fclasses is not None and record[5] not in self.fclasses:
+            return False
+        if self.fcodes is not None and record[6] not in self.fcodes:
+            return False
+        if self.min_population is not None and int(record[13] or 0) < self.min_population:
+            return False
+        return True
+
+    def keep_alternate_name(self, language):
+        return self.languages is None or language in self.languages
+
+    def staged_geoname_sql(self):
+        # The same test as keep_geoname, on the geoname_staging table
+        conditions = []
+        params = []
+        if self.countries is not None:
+            conditions.append('s.country_code = ANY(%s)')
+            params.append(sorted(self.countries))
+        rest = []
+        if self.fclasses is not None:
+            rest.append('s.fclass = ANY(%s)')
+            params.append(sorted(self.fclasses))
+        if self.fcodes is not None:
+            rest.append('s.fcode = ANY(%s)')
+            params.append(sorted(self.fcodes))
+        if self.min_population is not None:
+            rest.append("COALESCE(CAST(NULLIF(s.population, '') AS BIGINT), 0) >= %s")
+            params.append(self.min_population)
+        if rest:
+            conditions.append('(s.fcode IN (%s) OR (%s))' % \
+                (', '.join(["'%s'" % x for x in ADMIN_FCODES]), ' AND '.join(rest)))
+        return ' AND '.join(conditions) or 'TRUE', params
@@ -0,0 +1,274 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Records what the Geoname properties cost: how many times each one is
+# read, how many of those reads actually ran the getter, and the DB
+# queries, cache lookups and time spent underneath. Queries and cache
+# lookups are charged to the innermost property being computed; times
+# include the nested properties.
+#
+#     with Recorder() as recorder:
+#         g.hierarchy
+#     print recorder.summary()
+#
+# InstrumentationMiddleware does the same for every request, optionally
+# enforcing GEONAMES_QUERY_BUDGET.
+
+import time
+import logging
+from threading import local, Lock
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends import BaseDatabaseWrapper
+
+BUDGET_ACTIONS = ('log', 'raise')
+
+logger = logging.getLogger('geonames.instrumentation')
+
+_state = local()
+_install_lock = Lock()
+_installed = False
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def current():
+    return getattr(_state, 'recorder', None)
+
+class CountingCursor(object):
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+
+    def execute(self, *args, **kwargs):
+        self.recorder.query()
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.recorder.query()
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def install():
+    # Cursors and cache lookups are only wrapped while a recorder is
+    # active in the current thread. Connections are per thread, so the
+    # cursor is patched in their class, once for all of them.
+    global _installed
+    _install_lock.acquire()
+    try:
+        if _installed:
+            return
+        cursor = BaseDatabaseWrapper.cursor
+        def counting_cursor(self, *args, **kwargs):
+            c = cursor(self, *args, **kwargs)
+            recorder = current()
+            if recorder is None:
+                return c
+            return CountingCursor(c, recorder)
+        BaseDatabaseWrapper.cursor = counting_cursor
+
+        get = cache.get
+        def counting_get(key, default=None):
+            value = get(key, default)
+            recorder = current()
+            if recorder is not None:
+                recorder.cache_lookup(value is not default and 1 or 0, 1)
+            return value
+        cache.get = counting_get
+
+        get_many = cache.get_many
+        def counting_get_many(keys):
+            keys = list(keys)
+            values = get_many(keys)
+            recorder = current()
+            if recorder is not None:
+                recorder.cache_lookup(len(values), len(keys))
+            return values
+        cache.get_many = counting_get_many
+        _installed = True
+    finally:
+        _install_lock.release()
+
+class PropertyStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.misses = 0
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seconds = 0.0
+
+    @property
+    def hits(self):
+        return self.calls - self.misses
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'hits': self.hits,
+            'misses': self.misses,
+            'queries': self.queries,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'seconds': self.seconds,
+        }
+
+class Recorder(object):
+    def __init__(self, budget=None, action='log', label=None):
+        if action not in BUDGET_ACTIONS:
+            raise ValueError('Unknown query budget action: "%s"' % action)
+        self.budget = budget
+        self.action = action
+        self.label = label
+        self.properties = {}
+        self.stack = []
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seconds = 0.0
+        self.exceeded = False
+        self.previous = None
+        self.started = None
+
+    def start(self):
+        install()
+        self.previous = current()
+        _state.recorder = self
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        if self.started is not None:
+            self.seconds += time.time() - self.started
+            self.started = None
+            _state.recorder = self.previous
+            self.previous = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def stats(self, name):
+        try:
+            return self.properties[name]
+        except KeyError:
+            return self.properties.setdefault(name, PropertyStats(name))
+
+    def call(self, name, getter, *args):
+        stats = self.stats(name)
+        stats.calls += 1
+        self.stack.append(stats)
+        start = time.time()
+        try:
+            return getter(*args)
+        finally:
+            self.stack.pop()
+            # Recursive reads are already included in the outer one
+            if stats not in self.stack:
+                stats.seconds += time.time() - start
+
+    def computed(self, name):
+        self.stats(name).misses += 1
+
+    def query(self):
+        self.queries += 1
+        if self.stack:
+            self.stack[-1].queries += 1
+        if self.budget is not None and self.queries > self.budget and not self.exceeded:
+            self.exceeded = True
+            message = '%s exceeded the query budget of %d (in %s)' % (self.label or 'Recorder',
+                self.budget, ' > '.join([s.name for s in self.stack]) or 'no property')
+            if self.action == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+    def cache_lookup(self, hits, lookups):
+        self.cache_hits += hits
+        self.cache_misses += lookups - hits
+        if self.stack:
+            self.stack[-1].cache_hits += hits
+            self.stack[-1].cache_misses += lookups - hits
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'seconds': self.seconds,
+            'properties': dict([(name, s.as_dict()) for name, s in self.properties.items()]),
+        }
+
+    def summary(self):
+        lines = ['%s: %d queries, %d cache hits, %d cache misses, %.1f ms' % (self.label or 'Recorder',
+            self.queries, self.cache_hits, self.cache_misses, self.seconds * 1000)]
+        for s in sorted(self.properties.values(), key=lambda s: -s.seconds):
+            lines.append('  %s: %d calls (%d computed), %d queries, %d/%d cache hits, %.1f ms' % \
+                (s.name, s.calls, s.misses, s.queries, s.cache_hits, s.cache_hits + s.cache_misses,
+                s.seconds * 1000))
+        return '\n'.join(lines)
+
+class InstrumentedProperty(object):
+    def __init__(self, name, descriptor):
+        self.name = name
+        self.descriptor = descriptor
+        self.__doc__ = getattr(descriptor, '__doc__', None)
+
+    def __get__(self, obj, objtype=None):
+        recorder = current()
+        if obj is None or recorder is None:
+            return self.descriptor.__get__(obj, objtype)
+        return recorder.call(self.name, self.descriptor.__get__, obj, objtype)
+
+class InstrumentedDataProperty(InstrumentedProperty):
+    def __set__(self, obj, value):
+        self.descriptor.__set__(obj, value)
+
+    def __delete__(self, obj):
+        self.descriptor.__delete__(obj)
+
+def instrumented(decorator):
+    # Wraps a property decorator (stored_property, cached_property...),
+    # the getter is only called when the decorator has nothing cached
+    def decorate(func):
+        name = func.__name__
+        @wraps(func)
+        def compute(self):
+            recorder = current()
+            if recorder is not None:
+                recorder.computed(name)
+            return func(self)
+        descriptor = decorator(compute)
+        if hasattr(descriptor, '__set__'):
+            return InstrumentedDataProperty(name, descriptor)
+        return InstrumentedProperty(name, descriptor)
+    return decorate
+
+class InstrumentationMiddleware(object):
+    def process_request(self, request):
+        request.geonames_stats = Recorder(getattr(settings, 'GEONAMES_QUERY_BUDGET', None),
+            getattr(settings, 'GEONAMES_QUERY_BUDGET_ACTION', 'log'), request.path).start()
+
+    def finish(self, request):
+        recorder = getattr(request, 'geonames_stats', None)
+        if recorder is not None and recorder.started is not None:
+            recorder.stop()
+            logger.debug(recorder.summary())
+
+    def process_exception(self, request, exception):
+        self.finish(request)
+
+    def process_response(self, request, response):
+        self.finish(request)
+        return response
@@ -0,0 +1,147 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Objects looked up by primary key over and over (feature codes, time
+# zones, countries, admin codes, the globe...) are kept in a bounded LRU
+# in each process, in front of the Django cache. Keys in the Django cache
+# carry a version, the id of the latest geonames_update row, so applying
+# an update (which calls LookupCache.bump) invalidates every entry at once.
+# Processes notice a new version after at most VERSION_CHECK_INTERVAL
+# seconds.
+
+import time
+from copy import copy
+from threading import Lock
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+VERSION_KEY = 'geonames_lookup_version'
+VERSION_CHECK_INTERVAL = 60
+DEFAULT_SIZE = 10000
+
+class LookupCache(object):
+    def __init__(self, warm_models=()):
+        self.warm_models = warm_models
+        self.size = getattr(settings, 'GEONAMES_LOOKUP_CACHE_SIZE', DEFAULT_SIZE)
+        self.warm_on_start = getattr(settings, 'GEONAMES_LOOKUP_CACHE_WARM', True)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.version = None
+        self.checked = 0
+        self.warmed = False
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def db_version(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(id) FROM geonames_update')
+        return cursor.fetchone()[0] or 0
+
+    def check_version(self):
+        now = time.time()
+        if now - self.checked < VERSION_CHECK_INTERVAL:
+            return
+        self.checked = now
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            version = self.db_version()
+            cache.set(VERSION_KEY, version)
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.warmed = False
+        finally:
+            self.lock.release()
+
+    def bump(self):
+        # Called once the changes are committed
+        self.version = self.db_version()
+        self.checked = time.time()
+        cache.set(VERSION_KEY, self.version)
+        self.clear()
+
+    def key(self, model, pk):
+        return 'geonames_lookup:%s:%s:%s' % (self.version, model._meta.db_table, pk)
+
+    def store(self, key, obj):
+        self.lock.acquire()
+        try:
+            self.entries[key] = obj
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def local(self, key):
+        self.lock.acquire()
+        try:
+            obj = self.entries.pop(key)
+            self.entries[key] = obj
+            return obj
+        finally:
+            self.lock.release()
+
+    def get(self, model, pk):
+        # Callers get a copy, properties stored on it (translated names...)
+        # don't leak into the cached object
+        self.check_version()
+        if self.warm_on_start and not self.warmed:
+            self.warm()
+        key = self.key(model, pk)
+        try:
+            obj = self.local(key)
+            self.local_hits += 1
+            return copy(obj)
+        except KeyError:
+            pass
+
+        obj = cache.get(key)
+        if obj is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            obj = model.objects.get(pk=pk)
+            cache.set(key, obj)
+        self.store(key, obj)
+        return copy(obj)
+
+    def warm(self):
+        self.warmed = True
+        self.check_version()
+        for model in self.warm_models:
+            objs = dict([(self.key(model, obj.pk), obj) for obj in model.objects.all()])
+            if hasattr(cache, 'set_many'):
+                cache.set_many(objs)
+            else:
+                for key, obj in objs.items():
+                    cache.set(key, obj)
+            for key, obj in objs.items():
+                self.store(key, obj)
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            'version': self.version,
+            'size': len(self.entries),
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': lookups and float(self.local_hits + self.shared_hits) / lookups or 0.0,
+        }
+
+    def related(self, obj, name):
+        # Same as getattr(obj, name) for a foreign key, through the cache
+        pk = getattr(obj, name + '_id')
+        if pk is None:
+            return None
+        return self.get(obj._meta.get_field(name).rel.to, pk)
@@ -2,23 +2,85 @@
 # Copyright (c) 2008, Alberto Garcia Hierro
 # See LICENSE file for details
 
-from math import sin, cos, acos, radians
+import time
+from math import sin, cos, asin, sqrt, radians
+from threading import Lock
+from itertools import count, islice
 
 from django.core.cache import cache
 #from django.contrib.gis.db import models
-from django.db import connection, models
+from django.db import connection, models, transaction, DatabaseError
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext, get_language
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 
 from decorators import full_cached_property, cached_property, stored_property, cache_set
+from denorm import i18n_languages, import_setting, GLOBE_GEONAME_ID
+from instrumentation import instrumented, current, CountingCursor
+from lookup_cache import LookupCache
 
-GLOBE_GEONAME_ID = 6295630
+# Property reads show up in instrumentation.Recorder
+full_cached_property = instrumented(full_cached_property)
+cached_property = instrumented(cached_property)
+stored_property = instrumented(stored_property)
+
+NEAR_POINT_EXCLUDED_FCODES = ('PCLI', 'PCL', 'PCLD', 'CONT')
+
+# Geonames fetched at a time by the lazy near_point results
+NEAR_POINT_FETCH_SIZE = 100
+
+# Default search radius of Geoname.nearest
+NEAREST_MAX_KMS = 500
+
+# Seconds the languages recorded by the importer are trusted for
+I18N_LANGUAGES_CHECK_INTERVAL = 60
+
+def optional_table_query(func, *args):
+    # For tables (or functions) a deployment may not have created yet,
+    # None when the query fails. The savepoint keeps the transaction usable.
+    sid = transaction.savepoint()
+    try:
+        result = func(connection.cursor(), *args)
+    except DatabaseError:
+        transaction.savepoint_rollback(sid)
+        return None
+    transaction.savepoint_commit(sid)
+    return result
+
+def postgis_version(cursor):
+    cursor.execute('SELECT postgis_lib_version()')
+    return cursor.fetchone()[0]
+
+_i18n_languages = None
+_i18n_languages_checked = 0
+
+def i18n_name_languages():
+    # Languages with a precomputed entry in geoname_i18n_name, as recorded
+    # by the importer. Databases imported before the importer recorded
+    # them use GEONAMES_I18N_LANGUAGES.
+    global _i18n_languages, _i18n_languages_checked
+    now = time.time()
+    if _i18n_languages is None or now - _i18n_languages_checked >= I18N_LANGUAGES_CHECK_INTERVAL:
+        languages = optional_table_query(import_setting, 'i18n_languages')
+        if languages is None:
+            languages = i18n_languages(settings)
+        _i18n_languages = frozenset(languages)
+        _i18n_languages_checked = now
+    return _i18n_languages
 
 
 def translate_geoname(g, lang):
     cursor = connection.cursor()
+    if lang in i18n_name_languages():
+        cursor.execute('SELECT name FROM geoname_i18n_name WHERE geoname_id = %s AND language = %s',
+            (g.id, lang))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        return g.name
+
     cursor.execute('''SELECT name FROM alternate_name WHERE language='%(lang)s' \
         AND geoname_id = %(id)d AND preferred=TRUE UNION SELECT name \
         FROM alternate_name WHERE language='%(lang)s' AND geoname_id = %(id)d LIMIT 1''' % \
@@ -29,11 +91,138 @@ def translate_geoname(g, lang):
     except TypeError:
         return g.name
 
-def get_geo_translate_func():
+def translate_geonames(geonames, lang, chunk_size=1000):
+    names = {}
+    ids = list(set([g.id for g in geonames]))
+    cursor = connection.cursor()
+    materialised = lang in i18n_name_languages()
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        if materialised:
+            cursor.execute('SELECT geoname_id, name FROM geoname_i18n_name WHERE language = %%s ' \
+                'AND geoname_id IN (%s)' % ', '.join(['%s'] * len(chunk)), [lang] + chunk)
+            names.update(dict(cursor.fetchall()))
+            continue
+        cursor.execute('SELECT geoname_id, name FROM alternate_name WHERE language = %%s ' \
+            'AND geoname_id IN (%s) ORDER BY geoname_id, preferred DESC, id' % \
+            ', '.join(['%s'] * len(chunk)), [lang] + chunk)
+        for geoname_id, name in cursor.fetchall():
+            names.setdefault(geoname_id, name)
+
+    for g in geonames:
+        names.setdefault(g.id, g.name)
+    return names
+
+def translation_method():
     try:
-        cnf = settings.GEONAMES_TRANSLATION_METHOD
+        return settings.GEONAMES_TRANSLATION_METHOD
     except AttributeError:
-        cnf = 'NOOP'
+        return 'NOOP'
+
+def translation_language():
+    cnf = translation_method()
+    if cnf == 'STATIC':
+        lang = settings.LANGUAGE_CODE.split('-')[0]
+        if lang != 'en':
+            return lang
+    elif cnf == 'DYNAMIC':
+        return get_language()
+
+    return None
+
+def i18n_cache_key(geoname_id, lang):
+    if translation_method() == 'STATIC':
+        return 'Geoname_%s_i18n_name' % geoname_id
+    return 'Geoname_%s_%s_i18n_name' % (geoname_id, lang)
+
+def prefetched_i18n_name(g, lang):
+    try:
+        return g._i18n_names[lang]
+    except (AttributeError, KeyError):
+        return None
+
+# Seconds before a denormalized table found empty or missing is checked again
+DENORMALIZED_CHECK_INTERVAL = 60
+
+_denormalized = {}
+
+def table_has_rows(cursor, table):
+    cursor.execute('SELECT 1 FROM %s LIMIT 1' % table)
+    return cursor.fetchone() is not None
+
+def denormalized(table):
+    # Whether the importer has built the given denormalized table. Only
+    # a table with rows is remembered, one still being built (or not
+    # created yet) falls back to the old queries until it's filled.
+    built, checked = _denormalized.get(table, (False, 0))
+    now = time.time()
+    if not built and now - checked >= DENORMALIZED_CHECK_INTERVAL:
+        built = bool(optional_table_query(table_has_rows, table))
+        _denormalized[table] = (built, now)
+    return built
+
+_search_index = None
+_search_index_lock = Lock()
+
+def search_index():
+    # The NameIndex written by geonames-import --search-index, if any
+    global _search_index
+    if _search_index is None:
+        try:
+            path = settings.GEONAMES_SEARCH_INDEX
+        except AttributeError:
+            return None
+        _search_index_lock.acquire()
+        try:
+            if _search_index is None:
+                from search import NameIndex
+                _search_index = NameIndex.load(path)
+        finally:
+            _search_index_lock.release()
+    return _search_index
+
+def required_search_index():
+    index = search_index()
+    if index is None:
+        raise ImproperlyConfigured('Searching geonames without a sphinx index needs ' \
+            'GEONAMES_SEARCH_INDEX, the file written by geonames-import --search-index')
+    return index
+
+_snapshot = None
+_snapshot_lock = Lock()
+
+def snapshot():
+    # The read-only Snapshot written by geonames-import --snapshot, if any
+    global _snapshot
+    if _snapshot is None:
+        try:
+            path = settings.GEONAMES_SNAPSHOT
+        except AttributeError:
+            return None
+        _snapshot_lock.acquire()
+        try:
+            if _snapshot is None:
+                from snapshot import Snapshot
+                _snapshot = Snapshot(path)
+        finally:
+            _snapshot_lock.release()
+    return _snapshot
+
+def snapshot_geoname(row):
+    return Geoname(id=row['id'], name=row['name'], ascii_name=row['ascii_name'],
+        latitude=row['latitude'], longitude=row['longitude'], fclass=row['fclass'],
+        fcode=row['fcode'], country_id=row['country_id'], cc2=row['cc2'],
+        admin1_id=row['admin1_id'], admin2_id=row['admin2_id'], admin3_id=row['admin3_id'],
+        admin4_id=row['admin4_id'], population=row['population'], elevation=row['elevation'],
+        gtopo30=row['gtopo30'], timezone_id=row['timezone_id'], moddate=row['moddate'])
+
+def snapshot_timezone(row):
+    if row is None:
+        return None
+    return Timezone(**row)
+
+def get_geo_translate_func():
+    cnf = translation_method()
 
     if cnf == 'NOOP':
         return (lambda x: x.name)
@@ -44,7 +233,10 @@ def get_geo_translate_func():
             return (lambda x: x.name)
 
         def geo_translate(self):
-            key = 'Geoname_%s_i18n_name' % self.id
+            name = prefetched_i18n_name(self, lang)
+            if name is not None:
+                return name
+            key = i18n_cache_key(self.id, lang)
             return cache.get(key) or cache_set(key, translate_geoname(self, lang))
 
         return geo_translate
@@ -52,7 +244,10 @@ def get_geo_translate_func():
     if cnf == 'DYNAMIC':
         def geo_translate(self):
             lang = get_language()
-            key = 'Geoname_%s_%s_i18n_name' % (self.id, lang)
+            name = prefetched_i18n_name(self, lang)
+            if name is not None:
+                return name
+            key = i18n_cache_key(self.id, lang)
             return cache.get(key) or cache_set(key, translate_geoname(self, lang))
 
         return geo_translate
@@ -63,10 +258,46 @@ def get_geo_translate_func():
 geo_translate_func = get_geo_translate_func()
 
 class GeonameGISHelper(object):
-    def near_point(self, latitude, longitude, kms, order):
+    _tz_grid = None
+    _timezones = None
+
+    def near_point(self, latitude, longitude, kms, order, limit=None, fclasses=None, fcodes=None,
+            min_population=None, lazy=False):
         raise NotImplementedError
 
+    def nearest(self, latitude, longitude, k, max_kms):
+        return self.near_point(latitude, longitude, max_kms, True, limit=k)
+
+    def keep_near(self, g, fclasses, fcodes, min_population):
+        return (not fclasses or g.fclass in fclasses) and (not fcodes or g.fcode in fcodes) and \
+            (not min_population or g.population >= min_population)
+
+    def near_point_many(self, points, kms, order):
+        return [self.near_point(latitude, longitude, kms, order) for latitude, longitude in points]
+
+    def tz_grid(self):
+        if self._tz_grid is None:
+            try:
+                path = settings.GEONAMES_TZ_GRID
+            except AttributeError:
+                return None
+            from spatial import TimezoneGrid
+            self._timezones = dict([(tz.id, tz) for tz in Timezone.objects.all()])
+            self._tz_grid = TimezoneGrid.load(path)
+        return self._tz_grid
+
+    def aprox_tz_many(self, points):
+        grid = self.tz_grid()
+        if grid is None:
+            return [self.aprox_tz(latitude, longitude) for latitude, longitude in points]
+        tz_ids = grid.lookup_many([float(p[0]) for p in points], [float(p[1]) for p in points])
+        return [self._timezones.get(int(tz_id)) for tz_id in tz_ids]
+
     def aprox_tz(self, latitude, longitude):
+        grid = self.tz_grid()
+        if grid is not None:
+            return self._timezones.get(grid.lookup(latitude, longitude))
+
         cursor = connection.cursor()
         flat = float(latitude)
         flng = float(longitude)
@@ -86,37 +317,120 @@ class GeonameGISHelper(object):
 
 class PgSQLGeonameGISHelper(GeonameGISHelper):
     def box(self, minlat, maxlat, minlng, maxlng):
-        return 'SetSRID(MakeBox2D(MakePoint(%s, %s), MakePoint(%s, %s)), 4326)' % \
+        return 'ST_SetSRID(ST_MakeBox2D(ST_MakePoint(%s, %s), ST_MakePoint(%s, %s)), 4326)' % \
             (minlng, minlat, maxlng, maxlat)
 
-    def near_point(self, latitude, longitude, kms, order):
-        cursor = connection.cursor()
-        point = 'Transform(SetSRID(MakePoint(%s, %s), 4326), 32661)' % (longitude, latitude)
+    _cursor_names = count()
+    _knn = None
+
+    def knn(self):
+        # Whether the GiST indexes can be scanned in distance order (the <->
+        # operator), which needs PostGIS 2
+        if self._knn is None:
+            version = optional_table_query(postgis_version)
+            self._knn = version is not None and int(version.split('.')[0]) >= 2
+        return self._knn
+
+    def server_cursor(self):
+        # Rows of a named cursor stay in the server until they're fetched.
+        # WITH HOLD keeps it open after the transaction commits, so lazy
+        # results can be consumed after the request (iter_near closes it).
+        # psycopg1 and psycopg2 before 2.4.3 can't do that, their rows are
+        # fetched all at once.
+        connection.cursor()
+        try:
+            cursor = connection.connection.cursor('geonames_near_%d' % self._cursor_names.next(),
+                withhold=True)
+        except TypeError:
+            return connection.cursor()
+        # Named cursors don't go through connection.cursor()
+        recorder = current()
+        if recorder is not None:
+            return CountingCursor(cursor, recorder)
+        return cursor
+
+    def near_point(self, latitude, longitude, kms, order, limit=None, fclasses=None, fcodes=None,
+            min_population=None, lazy=False):
+        point = 'ST_Transform(ST_SetSRID(ST_MakePoint(%s, %s), 4326), 32661)' % \
+            (float(longitude), float(latitude))
+        filters = ''
+        params = []
+        for column, values in (('fclass', fclasses), ('fcode', fcodes)):
+            if values:
+                filters += ' AND %s IN (%s)' % (column, ', '.join(['%s'] * len(values)))
+                params.extend(values)
+        if min_population:
+            filters += ' AND population >= %s'
+            params.append(min_population)
         ord = ''
-        if order:
-            ord = 'ORDER BY distance(%s, gpoint_meters)' % point
-        cursor.execute('SELECT %(fields)s, distance(%(point)s, gpoint_meters) ' \
+        if order and limit and self.knn():
+            # k-NN scan of the GiST index on gpoint_meters, it stops after
+            # limit rows instead of sorting the whole radius
+            ord = ' ORDER BY gpoint_meters <-> %s' % point
+        elif order:
+            ord = ' ORDER BY ST_Distance(%s, gpoint_meters)' % point
+        if limit:
+            ord += ' LIMIT %d' % limit
+        sql = 'SELECT %(fields)s, ST_Distance(%(point)s, gpoint_meters) ' \
                 'FROM geoname WHERE fcode NOT IN (%(excluded)s) AND ' \
                 'ST_DWithin(%(point)s, gpoint_meters, %(meters)s)' \
-                '%(order)s' %  \
-            {   
+                '%(filters)s%(order)s' %  \
+            {
                 'fields': Geoname.select_fields(),
                 'point': point,
-                'excluded': "'PCLI', 'PCL', 'PCLD', 'CONT'",
+                'excluded': ', '.join(["'%s'" % x for x in NEAR_POINT_EXCLUDED_FCODES]),
                 'meters': kms * 1000,
+                'filters': filters,
                 'order': ord,
             }
-        )
 
+        if lazy:
+            return self.iter_near(sql, params)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
         return [(Geoname(*row[:-1]), row[-1]) for row in cursor.fetchall()]
 
-    def box_tz(self, cursor, minlat, maxlat, minlng, maxlng):
-        print('SELECT timezone_id FROM geoname WHERE ST_Within(gpoint, %(box)s) ' \
-            'AND timezone_id IS NOT NULL LIMIT 1' % \
+    def iter_near(self, sql, params):
+        cursor = self.server_cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(NEAR_POINT_FETCH_SIZE)
+            while rows:
+                for row in rows:
+                    yield (Geoname(*row[:-1]), row[-1])
+                rows = cursor.fetchmany(NEAR_POINT_FETCH_SIZE)
+        finally:
+            cursor.close()
+
+    def near_point_many(self, points, kms, order):
+        if not points:
+            return []
+        values = ', '.join(['(%d, ST_Transform(ST_SetSRID(ST_MakePoint(%s, %s), 4326), 32661))' % \
+            (i, float(longitude), float(latitude)) for i, (latitude, longitude) in enumerate(points)])
+        ord = ''
+        if order:
+            ord = ', 2'
+        cursor = connection.cursor()
+        cursor.execute('SELECT q.idx, ST_Distance(q.point, g.gpoint_meters), %(fields)s ' \
+                'FROM geoname g, (VALUES %(values)s) AS q (idx, point) ' \
+                'WHERE g.fcode NOT IN (%(excluded)s) AND ' \
+                'ST_DWithin(q.point, g.gpoint_meters, %(meters)s) ' \
+                'ORDER BY 1%(order)s' % \
             {
-                'box': self.box(minlat, maxlat, minlng, maxlng),
+                'fields': Geoname.select_fields('g'),
+                'values': values,
+                'excluded': ', '.join(["'%s'" % x for x in NEAR_POINT_EXCLUDED_FCODES]),
+                'meters': kms * 1000,
+                'order': ord,
             }
         )
+
+        results = [[] for point in points]
+        for row in cursor.fetchall():
+            results[row[0]].append((Geoname(*row[2:]), row[1]))
+        return results
+
+    def box_tz(self, cursor, minlat, maxlat, minlng, maxlng):
         cursor.execute('SELECT timezone_id FROM geoname WHERE ST_Within(gpoint, %(box)s) ' \
             'AND timezone_id IS NOT NULL LIMIT 1' % \
             {
@@ -125,17 +439,123 @@ class PgSQLGeonameGISHelper(GeonameGISHelper):
         )
         row = cursor.fetchone()
         if row:
-            return Timezone.objects.get(pk=row[0])
+            return lookups.get(Timezone, row[0])
 
         return None
 
+class MemoryGeonameGISHelper(GeonameGISHelper):
+    def __init__(self):
+        self._index = None
+        self._lock = Lock()
+
+    def index(self):
+        if self._index is None:
+            self._lock.acquire()
+            try:
+                if self._index is None:
+                    self._index = self.build_index()
+            finally:
+                self._lock.release()
+        return self._index
+
+    def build_index(self):
+        from spatial import GeoIndex
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, latitude, longitude, timezone_id FROM geoname ' \
+            'WHERE fcode NOT IN (%s)' % ', '.join(['%s'] * len(NEAR_POINT_EXCLUDED_FCODES)),
+            NEAR_POINT_EXCLUDED_FCODES)
+        ids, lats, lngs, tzs = [], [], [], []
+        for row in cursor.fetchall():
+            ids.append(row[0])
+            lats.append(float(row[1]))
+            lngs.append(float(row[2]))
+            tzs.append(row[3] or 0)
+        try:
+            cell_size = settings.GEONAMES_INDEX_CELL_SIZE
+        except AttributeError:
+            cell_size = 0.25
+        return GeoIndex(ids, lats, lngs, cell_size, values=tzs)
+
+    def reload(self):
+        self._index = None
+
+    def near_point(self, latitude, longitude, kms, order, limit=None, fclasses=None, fcodes=None,
+            min_population=None, lazy=False):
+        index = self.index()
+        if order and limit and not (fclasses or fcodes or min_population):
+            # The radius grows from a single cell until limit geonames are in
+            positions, distances = index.nearest(latitude, longitude, limit, kms)
+        else:
+            positions, distances = index.within(latitude, longitude, kms, order)
+        ids = [int(x) for x in index.ids[positions]]
+        results = self.iter_near(ids, distances, (lazy or limit) and NEAR_POINT_FETCH_SIZE,
+            limit, fclasses, fcodes, min_population)
+        if lazy:
+            return results
+        return list(results)
+
+    def iter_near(self, ids, distances, fetch_size, limit, fclasses, fcodes, min_population):
+        # Geonames are loaded fetch_size at a time (all of them when it's
+        # None), until limit of them have passed the filters
+        fetch_size = fetch_size or max(len(ids), 1)
+        found = 0
+        for start in range(0, len(ids), fetch_size):
+            chunk = ids[start:start + fetch_size]
+            objs = Geoname.objects.in_bulk(chunk)
+            for i, d in zip(chunk, distances[start:start + fetch_size]):
+                g = objs.get(i)
+                if g is None or not self.keep_near(g, fclasses, fcodes, min_population):
+                    continue
+                yield (g, d * 1000)
+                found += 1
+                if found == limit:
+                    return
+
+    def near_point_many(self, points, kms, order):
+        index = self.index()
+        matches = []
+        for latitude, longitude in points:
+            positions, distances = index.within(latitude, longitude, kms, order)
+            matches.append(([int(x) for x in index.ids[positions]], distances))
+        objs = Geoname.objects.in_bulk(set([i for ids, distances in matches for i in ids]))
+        return [[(objs[i], d * 1000) for i, d in zip(ids, distances) if i in objs] \
+            for ids, distances in matches]
+
+    def box_tz(self, cursor, minlat, maxlat, minlng, maxlng):
+        index = self.index()
+        tzs = index.values[index.within_box(minlat, maxlat, minlng, maxlng)]
+        tzs = tzs[tzs != 0]
+        if len(tzs):
+            return lookups.get(Timezone, int(tzs[0]))
+
+        return None
+
+class SnapshotGeonameGISHelper(GeonameGISHelper):
+    def near_point(self, latitude, longitude, kms, order, limit=None, fclasses=None, fcodes=None,
+            min_population=None, lazy=False):
+        results = ((snapshot_geoname(row), distance) for row, distance in \
+            snapshot().near_point(latitude, longitude, kms, order, NEAR_POINT_EXCLUDED_FCODES,
+                limit, fclasses, fcodes, min_population))
+        if lazy:
+            return results
+        return list(results)
+
+    def aprox_tz(self, latitude, longitude):
+        return snapshot_timezone(snapshot().aprox_tz(latitude, longitude))
+
+    def aprox_tz_many(self, points):
+        return [self.aprox_tz(latitude, longitude) for latitude, longitude in points]
+
 GIS_HELPERS = {
     'postgresql_psycopg2': PgSQLGeonameGISHelper,
     'postgresql': PgSQLGeonameGISHelper,
+    'sqlite3': MemoryGeonameGISHelper,
+    'memory': MemoryGeonameGISHelper,
+    'snapshot': SnapshotGeonameGISHelper,
 }
 
 try:
-    GISHelper = GIS_HELPERS[settings.DATABASE_ENGINE]()
+    GISHelper = GIS_HELPERS[getattr(settings, 'GEONAMES_GIS_HELPER', settings.DATABASE_ENGINE)]()
 except KeyError:
     print 'Sorry, your database backend is not supported by the Geonames application'
 
@@ -188,7 +608,7 @@ class Geoname(models.Model):
     @stored_property
     def fcode_name(self):
         try:
-            return ugettext(FeatureCode.objects.get(pk=self.fcode).name)
+            return ugettext(lookups.get(FeatureCode, self.fcode).name)
         except FeatureCode.DoesNotExist:
             return u''
 
@@ -210,6 +630,10 @@ class Geoname(models.Model):
     def parent(self):
         if self.id == GLOBE_GEONAME_ID:
             return None
+        if denormalized('geoname_ancestor'):
+            parents = list(Geoname.objects.filter(descendant_set__geoname=self.id,
+                descendant_set__depth=1))
+            return parents and parents[0] or None
         return self.get_parent
 
     @cached_property
@@ -218,23 +642,26 @@ class Geoname(models.Model):
         if self.fcode == 'CONT':
             return Geoname.globe()
 
+        country = lookups.related(self, 'country')
+        continent = lookups.related(country, 'continent')
+        admin = lambda level: lookups.related(self, 'admin%d' % level)
         if self.fcode.startswith('PCL'):
-            g_list = [self.country.continent]
+            g_list = [continent]
         elif self.fcode in ('ADM1', 'ADMD'):
-            g_list = [self.country, self.country.continent]
+            g_list = [country, continent]
         elif self.fcode == 'ADM2':
-            g_list = [self.admin1, self.country, self.country.continent]
+            g_list = [admin(1), country, continent]
         elif self.fcode == 'ADM3':
-            g_list = [self.admin2, self.admin1, self.country, self.country.continent]
+            g_list = [admin(2), admin(1), country, continent]
         elif self.fcode == 'ADM4':
-            g_list = [self.admin3, self.admin2, self.admin1, self.country, self.country.continent]
+            g_list = [admin(3), admin(2), admin(1), country, continent]
         else:
-            g_list = [self.admin4, self.admin3, self.admin2, self.admin1, self.country, self.country.continent]
+            g_list = [admin(4), admin(3), admin(2), admin(1), country, continent]
 
         for g in g_list:
             try:
                 if g.geoname_id != self.id:
-                    return g.geoname
+                    return lookups.get(Geoname, g.geoname_id)
             except AttributeError:
                 pass
 
@@ -242,15 +669,29 @@ class Geoname(models.Model):
 
     @full_cached_property
     def hierarchy(self):
+        return self.get_hierarchy()
+
+    def get_hierarchy(self):
+        snap = snapshot()
+        if snap is not None:
+            return Geoname.prefetch_i18n([snapshot_geoname(row) for row in snap.hierarchy(self.id)])
+        if denormalized('geoname_ancestor'):
+            return Geoname.prefetch_i18n(Geoname.ancestors(self.id))
+
         hier = []
         parent = self.parent
         while parent:
             hier.append(parent)
             parent = parent.parent
 
-        return hier
+        return Geoname.prefetch_i18n(hier)
 
     def get_children(self):
+        if denormalized('geoname_child'):
+            return Geoname.objects.extra(tables=['geoname_child'],
+                where=['geoname_child.child_id = geoname.id', 'geoname_child.parent_id = %s'],
+                params=[self.id], order_by=['geoname_child.position'])
+
         if self.id == GLOBE_GEONAME_ID:
             return Geoname.objects.filter(id__in=[x['geoname'] for x in Continent.objects.values('geoname')])
 
@@ -286,10 +727,26 @@ class Geoname(models.Model):
     @full_cached_property
     def children(self):
         cset = self.get_children()
-        l = list(cset or [])
+        if denormalized('geoname_child'):
+            # Same order as children_page, by position (the name)
+            return Geoname.prefetch_i18n(list(cset))
+        # Without geoname_child the children come in no particular order,
+        # so they're sorted by their translated names. children_page can't
+        # do that without loading every child, its pages are unordered
+        # until geoname_child is built
+        l = Geoname.prefetch_i18n(list(cset or []))
         l.sort(cmp=lambda x,y: cmp(x.i18n_name, y.i18n_name))
         return l
 
+    @stored_property
+    def child_count(self):
+        if denormalized('geoname_child'):
+            return GeonameChild.objects.filter(parent=self.id).count()
+        return self.get_children().count()
+
+    def children_page(self, offset=0, limit=20):
+        return Geoname.prefetch_i18n(list(self.get_children()[offset:offset + limit]))
+
     @property
     def reluri(self):
         if not self.is_globe():
@@ -313,9 +770,20 @@ class Geoname(models.Model):
         except IndexError:
             return None
 
+    @staticmethod
+    def lookup(geoname_id):
+        # Served from the snapshot when there's one
+        snap = snapshot()
+        if snap is None:
+            return Geoname.objects.get(pk=geoname_id)
+        row = snap.get(int(geoname_id))
+        if row is None:
+            raise Geoname.DoesNotExist('Geoname %s does not exist' % geoname_id)
+        return snapshot_geoname(row)
+
     @staticmethod
     def globe():
-        return Geoname.objects.get(pk=GLOBE_GEONAME_ID)
+        return lookups.get(Geoname, GLOBE_GEONAME_ID)
 
     def is_globe(self):
         return self.id == GLOBE_GEONAME_ID
@@ -325,6 +793,8 @@ class Geoname(models.Model):
             return True
         try:
             if self.fcode == 'CONT':
+                if denormalized('geoname_ancestor'):
+                    return GeonameAncestor.objects.filter(geoname=child.id, ancestor=self.id).count() > 0
                 return child.country.continent.geoname == self
             if self.fcode in ('PCLI', 'PCLD'):
                 return child.country_id == self.country_id
@@ -342,7 +812,62 @@ class Geoname(models.Model):
         return False
 
     @staticmethod
-    def query(q, index, max_count=10):
+    def ancestors(geoname_id):
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s FROM geoname_ancestor a JOIN geoname g ON g.id = a.ancestor_id ' \
+            'WHERE a.geoname_id = %%s ORDER BY a.depth' % Geoname.select_fields('g'), (geoname_id,))
+        return [Geoname(*row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def prefetch_i18n(geonames, lang=None):
+        if lang is None:
+            lang = translation_language()
+        if lang is None:
+            return geonames
+
+        pending = {}
+        for g in geonames:
+            if prefetched_i18n_name(g, lang) is None:
+                pending.setdefault(i18n_cache_key(g.id, lang), []).append(g)
+        if not pending:
+            return geonames
+
+        names = cache.get_many(pending.keys())
+        missing = [objs[0] for key, objs in pending.items() if not names.get(key)]
+        if missing:
+            fetched = dict([(i18n_cache_key(geoname_id, lang), name) for geoname_id, name in \
+                translate_geonames(missing, lang).items()])
+            if hasattr(cache, 'set_many'):
+                cache.set_many(fetched)
+            else:
+                for key, name in fetched.items():
+                    cache_set(key, name)
+            names.update(fetched)
+
+        for key, objs in pending.items():
+            for g in objs:
+                if not hasattr(g, '_i18n_names'):
+                    g._i18n_names = {}
+                g._i18n_names[lang] = names[key]
+
+        return geonames
+
+    @staticmethod
+    def in_order(ids):
+        objs = Geoname.objects.in_bulk(ids)
+        return [objs[i] for i in ids if i in objs]
+
+    @staticmethod
+    def autocomplete(prefix, max_count=10):
+        ids = required_search_index().complete(prefix, max_count)
+        return Geoname.prefetch_i18n(Geoname.in_order(ids))
+
+    @staticmethod
+    def query(q, index=None, max_count=10):
+        if index is None:
+            ids = required_search_index().search(q, max_count)
+            return Geoname.prefetch_i18n(Geoname.in_order(ids))
+
         def location_results_order(x, y):
             codes = { '': 0, 'CONT': 1, 'PCLI': 2, 'ADM1': 3, 'ADM2': 4, 'ADM3': 5, 'ADM4': 6, 'PPL': 7 }
             return cmp(codes.get(x.fcode, 20), codes.get(y.fcode, 20)) or cmp(x.population, y.population)
@@ -352,14 +877,14 @@ class Geoname(models.Model):
             set = Geoname.name_search.query(q).on_index(index)
             result_set = list(set)
             result_set.sort(cmp=location_results_order)
-            return result_set[:max_count]
+            return Geoname.prefetch_i18n(result_set[:max_count])
 
         result_set = Geoname.name_search.query(q).on_index(index)
         if result_set.count() > 0:
             result_set = list(result_set)
             #result_set.sort(cmp=location_results_order)
             result_set.sort(cmp=lambda x,y: cmp(len(x.name), len(y.name)))
-            return result_set[:max_count]
+            return Geoname.prefetch_i18n(result_set[:max_count])
 
         result_set = list(result_set)
         sets = []
@@ -376,37 +901,74 @@ class Geoname(models.Model):
                         set[item.id] = item
         result_set += set.values()
         result_set.sort(cmp=location_results_order)
-        return result_set[:max_count]
+        return Geoname.prefetch_i18n(result_set[:max_count])
 
     def distance(self, other):
         return Geoname.distance_points(self.latitude, self.longitude, other.latitude, other.longitude)
 
-    def near(self, kms=20, order=True):
-        try:
-            return Geoname.near_point(self.latitude, self.longitude, kms, order)[1:]
-        except IndexError:
-            return Geoname.objects.none()
+    def near(self, kms=20, order=True, limit=None, lazy=False, **filters):
+        # The geoname itself may not be the first result (or be there at
+        # all, if it's filtered out), so it's dropped by id
+        results = Geoname.near_point(self.latitude, self.longitude, kms, order,
+            limit=limit and limit + 1, lazy=lazy, **filters)
+        results = islice(((g, d) for g, d in results if g.id != self.id), limit)
+        if lazy:
+            return results
+        return list(results)
 
     @staticmethod
-    def select_fields():
-        return 'id, name, ascii_name, latitude, longitude, fclass, fcode,' \
-                ' country_id, cc2, admin1_id, admin2_id, admin3_id, ' \
-                ' admin4_id, population, elevation, gtopo30, timezone_id, moddate'
+    def select_fields(table=None):
+        fields = ('id', 'name', 'ascii_name', 'latitude', 'longitude', 'fclass', 'fcode',
+            'country_id', 'cc2', 'admin1_id', 'admin2_id', 'admin3_id',
+            'admin4_id', 'population', 'elevation', 'gtopo30', 'timezone_id', 'moddate')
+        if table:
+            fields = ['%s.%s' % (table, f) for f in fields]
+        return ', '.join(fields)
 
     @staticmethod
     def distance_points(lat1, lon1, lat2, lon2, is_rad=False):
         if not is_rad:
             lat1, lon1, lat2, lon2 = map(lambda x: radians(float(x)), (lat1, lon1, lat2, lon2))
-        return 6378.7 * acos(sin(lat1) * sin(lat2) + cos(lat1) * cos(lat2) * cos(lon2 - lon1))
+        a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        return 2 * 6378.7 * asin(sqrt(min(a, 1.0)))
+
+    @staticmethod
+    def distances(origin, others):
+        from spatial import distances_from
+        return distances_from(float(origin.latitude), float(origin.longitude),
+            [float(g.latitude) for g in others], [float(g.longitude) for g in others])
 
     @staticmethod
-    def near_point(latitude, longitude, kms=20, order=True):
-        return GISHelper.near_point(latitude, longitude, kms, order)
+    def distance_matrix(rows, columns):
+        from spatial import distance_matrix
+        return distance_matrix([float(g.latitude) for g in rows], [float(g.longitude) for g in rows],
+            [float(g.latitude) for g in columns], [float(g.longitude) for g in columns])
+
+    @staticmethod
+    def near_point(latitude, longitude, kms=20, order=True, limit=None, fclasses=None, fcodes=None,
+            min_population=None, lazy=False):
+        # [(geoname, distance in meters)], or an iterator over them when lazy.
+        # With order and limit the nearest geonames are returned.
+        return GISHelper.near_point(latitude, longitude, kms, order, limit, fclasses, fcodes,
+            min_population, lazy)
+
+    @staticmethod
+    def nearest(latitude, longitude, k=10, max_kms=NEAREST_MAX_KMS):
+        # The k geonames closest to the point, nearest first
+        return GISHelper.nearest(latitude, longitude, k, max_kms)
+
+    @staticmethod
+    def near_point_many(points, kms=20, order=True):
+        return GISHelper.near_point_many(points, kms, order)
 
     @staticmethod
     def aprox_tz(latitude, longitude):
         return GISHelper.aprox_tz(latitude, longitude)
 
+    @staticmethod
+    def aprox_tz_many(points):
+        return GISHelper.aprox_tz_many(points)
+
 class GeonameAlternateName(models.Model):
     id = models.IntegerField(primary_key=True)
     geoname = models.ForeignKey(Geoname, related_name='altnames', db_index=True)
@@ -421,6 +983,33 @@ class GeonameAlternateName(models.Model):
     def __unicode__(self):
         return self.alternateName
 
+class GeonameI18nName(models.Model):
+    geoname = models.ForeignKey(Geoname, related_name='i18n_names')
+    language = models.CharField(max_length=7)
+    name = models.CharField(max_length=200)
+
+    class Meta:
+        db_table = 'geoname_i18n_name'
+        unique_together = (('geoname', 'language'),)
+
+class GeonameAncestor(models.Model):
+    geoname = models.ForeignKey(Geoname, related_name='ancestor_set')
+    ancestor = models.ForeignKey(Geoname, related_name='descendant_set', db_index=True)
+    depth = models.IntegerField()
+
+    class Meta:
+        db_table = 'geoname_ancestor'
+        unique_together = (('geoname', 'depth'),)
+
+class GeonameChild(models.Model):
+    parent = models.ForeignKey(Geoname, related_name='child_set')
+    child = models.ForeignKey(Geoname, related_name='parent_set', db_index=True)
+    position = models.IntegerField()
+
+    class Meta:
+        db_table = 'geoname_child'
+        unique_together = (('parent', 'position'),)
+
 class Continent(models.Model):
     code = models.CharField(max_length=2, primary_key=True)
     name = models.CharField(max_length=20)
@@ -535,3 +1124,12 @@ class GeonamesUpdate(models.Model):
 
     class Meta:
         db_table = 'geonames_update'
+
+class GeonamesImportSetting(models.Model):
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.TextField()
+
+    class Meta:
+        db_table = 'geonames_import_setting'
+
+lookups = LookupCache((FeatureCode, Timezone, Continent, Country, Admin1Code))
@@ -0,0 +1,223 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from heapq import merge
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Same priorities used to sort Geoname.query results
+FCODE_PRIORITY = { '': 0, 'CONT': 1, 'PCLI': 2, 'ADM1': 3, 'ADM2': 4, 'ADM3': 5, 'ADM4': 6, 'PPL': 7 }
+
+# Prefixes up to this length get their best matches precomputed, so
+# autocompleting the first keystrokes doesn't merge huge posting lists
+SHORT_PREFIX = 3
+SHORT_PREFIX_RESULTS = 50
+
+FETCH_SIZE = 10000
+
+_split_re = re.compile(r'\W+', re.UNICODE)
+
+def location_rank(fcode, population):
+    return (FCODE_PRIORITY.get(fcode, 20), population)
+
+def normalize(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join([c for c in text if not unicodedata.combining(c)])
+
+def tokenize(text):
+    return [t for t in _split_re.split(normalize(text)) if t]
+
+def fetch_rows(cursor, sql, params=()):
+    cursor.execute(sql, params)
+    rows = cursor.fetchmany(FETCH_SIZE)
+    while rows:
+        for row in rows:
+            yield row
+        rows = cursor.fetchmany(FETCH_SIZE)
+
+class NameIndex(object):
+    # Geonames are numbered by their rank (fcode priority, population),
+    # so every posting list is kept sorted by rank and the best k
+    # results are simply the k smallest ordinals.
+    def __init__(self, ids, parents, postings, short_prefixes):
+        self.ids = ids
+        self.parents = parents
+        self.postings = postings
+        self.tokens = sorted(postings.keys())
+        self.short_prefixes = short_prefixes
+
+    @classmethod
+    def build(cls, geonames, names, parents):
+        geonames = sorted(geonames, key=lambda g: location_rank(g[3], g[4]) + (g[0],))
+        ordinals = {}
+        ids = array('l')
+        for g in geonames:
+            ordinals[g[0]] = len(ids)
+            ids.append(g[0])
+
+        tokens = {}
+        def add(ordinal, text):
+            for token in tokenize(text or ''):
+                tokens.setdefault(token, set()).add(ordinal)
+
+        for g in geonames:
+            add(ordinals[g[0]], g[1])
+            add(ordinals[g[0]], g[2])
+        for geoname_id, name in names:
+            try:
+                add(ordinals[geoname_id], name)
+            except KeyError:
+                pass
+        postings = dict([(token, array('l', sorted(ords))) for token, ords in tokens.items()])
+
+        parent_ordinals = array('l', [-1]) * len(ids)
+        for geoname_id, parent_id in parents:
+            try:
+                parent_ordinals[ordinals[geoname_id]] = ordinals[parent_id]
+            except KeyError:
+                pass
+
+        short_prefixes = {}
+        for token, ords in postings.items():
+            for length in range(1, min(SHORT_PREFIX, len(token)) + 1):
+                short_prefixes.setdefault(token[:length], []).append(ords[:SHORT_PREFIX_RESULTS])
+        for prefix, lists in short_prefixes.items():
+            best = sorted(set([o for l in lists for o in l]))[:SHORT_PREFIX_RESULTS]
+            short_prefixes[prefix] = array('l', best)
+
+        return cls(ids, parent_ordinals, postings, short_prefixes)
+
+    @classmethod
+    def from_cursor(cls, cursor, fclasses=None, languages=None):
+        where = ''
+        params = ()
+        if fclasses:
+            where = ' WHERE fclass IN (%s)' % ', '.join(['%s'] * len(fclasses))
+            params = tuple(fclasses)
+        geonames = list(fetch_rows(cursor,
+            'SELECT id, name, ascii_name, fcode, population FROM geoname' + where, params))
+
+        # languages=None indexes every alternate name, an empty list none
+        names = ()
+        if languages is None:
+            names = fetch_rows(cursor, 'SELECT geoname_id, name FROM alternate_name')
+        elif languages:
+            names = fetch_rows(cursor, 'SELECT geoname_id, name FROM alternate_name ' \
+                'WHERE language IN (%s)' % ', '.join(['%s'] * len(languages)), tuple(languages))
+        index = cls.build(geonames, names, [])
+        ordinals = dict([(geoname_id, i) for i, geoname_id in enumerate(index.ids)])
+        for geoname_id, parent_id in fetch_rows(cursor,
+                'SELECT geoname_id, ancestor_id FROM geoname_ancestor WHERE depth = 1'):
+            try:
+                index.parents[ordinals[geoname_id]] = ordinals[parent_id]
+            except KeyError:
+                pass
+        return index
+
+    @classmethod
+    def load(cls, path):
+        fd = open(path, 'rb')
+        try:
+            data = pickle.load(fd)
+        finally:
+            fd.close()
+        return cls(*data)
+
+    def save(self, path):
+        fd = open(path, 'wb')
+        pickle.dump((self.ids, self.parents, self.postings, self.short_prefixes), fd, 2)
+        fd.close()
+
+    def prefix_postings(self, prefix):
+        i = bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            yield self.postings[self.tokens[i]]
+            i += 1
+
+    def match(self, words, limit=None):
+        # All the words but the last one must match whole tokens, the
+        # last one is matched as a prefix (the user may still be typing)
+        if not words:
+            return []
+        last = words[-1]
+        if len(words) == 1 and len(last) <= SHORT_PREFIX and limit is not None \
+                and limit <= SHORT_PREFIX_RESULTS:
+            return list(self.short_prefixes.get(last, ()))[:limit]
+
+        sets = []
+        for word in words[:-1]:
+            try:
+                sets.append(self.postings[word])
+            except KeyError:
+                return []
+        sets.sort(key=len)
+        candidates = None
+        if sets:
+            candidates = set(sets[0])
+            for s in sets[1:]:
+                candidates.intersection_update(s)
+            if not candidates:
+                return []
+
+        results = []
+        previous = None
+        for ordinal in merge(*list(self.prefix_postings(last))):
+            if ordinal == previous:
+                continue
+            previous = ordinal
+            if candidates is None or ordinal in candidates:
+                results.append(ordinal)
+                if limit is not None and len(results) == limit:
+                    break
+        return results
+
+    def ancestors(self, ordinal):
+        seen = set()
+        parent = self.parents[ordinal]
+        while parent != -1 and parent not in seen:
+            seen.add(parent)
+            parent = self.parents[parent]
+        return seen
+
+    def search(self, q, limit=10):
+        if ',' in q:
+            terms = [tokenize(t) for t in q.split(',')]
+            terms = [t for t in terms if t]
+        else:
+            terms = [[w] for w in tokenize(q)]
+        if not terms:
+            return []
+
+        words = [w for t in terms for w in t]
+        results = self.match(words, limit)
+        if results or len(terms) == 1:
+            return [self.ids[o] for o in results]
+
+        # "city, region": keep the matches of one term which lie inside a
+        # match of every other term
+        matches = [self.match(t) for t in terms]
+        sets = [set(m) for m in matches]
+        found = set()
+        for i, term_matches in enumerate(matches):
+            others = [s for j, s in enumerate(sets) if j != i]
+            for ordinal in term_matches:
+                ancestors = self.ancestors(ordinal)
+                for other in others:
+                    if not ancestors.intersection(other):
+                        break
+                else:
+                    found.add(ordinal)
+        return [self.ids[o] for o in sorted(found)[:limit]]
+
+    def complete(self, prefix, limit=10):
+        return [self.ids[o] for o in self.match(tokenize(prefix), limit)]
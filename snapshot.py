@@ -0,0 +1,317 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# A read-only copy of the columns needed to serve geonames without a
+# database. Every column is a plain NumPy array at an aligned offset of a
+# single file and strings are stored as an offsets array plus a heap of
+# UTF-8 bytes. Opening it just maps the file, so startup is immediate and
+# every process reading the same snapshot shares the page cache.
+
+import os
+import json
+import struct
+from datetime import date
+
+import numpy
+
+from denorm import MAX_ANCESTOR_DEPTH
+from search import fetch_rows
+from spatial import DEFAULT_CELL_SIZE, GeoIndex, TimezoneGrid
+
+MAGIC = b'GEOSNAP\n'
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+CHUNK_SIZE = 10000
+
+# Foreign keys and other missing values are stored as -1, dates as their
+# ordinal
+GEONAME_COLUMNS = (
+    ('id', numpy.int32),
+    ('latitude', numpy.float64),
+    ('longitude', numpy.float64),
+    ('fclass', 'S1'),
+    ('fcode', 'S10'),
+    ('country_id', 'S2'),
+    ('admin1_id', numpy.int32),
+    ('admin2_id', numpy.int32),
+    ('admin3_id', numpy.int32),
+    ('admin4_id', numpy.int32),
+    ('population', numpy.int64),
+    ('elevation', numpy.int32),
+    ('gtopo30', numpy.int32),
+    ('timezone_id', numpy.int16),
+    ('moddate', numpy.int32),
+    ('parent_id', numpy.int32),
+)
+
+# Columns where -1 is a value, not a missing one
+NOT_NULL_COLUMNS = ('elevation', 'gtopo30')
+
+# Stored as offsets plus a heap, after GEONAME_COLUMNS in GEONAME_SQL
+GEONAME_STRING_COLUMNS = ('name', 'ascii_name', 'cc2')
+
+GEONAME_SQL = 'SELECT g.id, g.latitude, g.longitude, g.fclass, g.fcode, g.country_id, ' \
+    'g.admin1_id, g.admin2_id, g.admin3_id, g.admin4_id, g.population, g.elevation, ' \
+    'g.gtopo30, g.timezone_id, g.moddate, p.ancestor_id, g.name, g.ascii_name, g.cc2 ' \
+    'FROM geoname g ' \
+    'LEFT JOIN geoname_ancestor p ON p.geoname_id = g.id AND p.depth = 1'
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def encode(value):
+    if value is None:
+        return b''
+    if not isinstance(value, bytes):
+        return value.encode('utf-8')
+    return value
+
+def number(value):
+    if value is None:
+        return -1
+    if isinstance(value, date):
+        return value.toordinal()
+    return value
+
+def column(values, dtype):
+    if numpy.dtype(dtype).kind in 'SU':
+        return numpy.array([encode(v) for v in values], dtype=dtype)
+    return numpy.array([number(v) for v in values], dtype=dtype)
+
+class SnapshotWriter(object):
+    def __init__(self):
+        self.sections = []
+
+    def add(self, name, array):
+        self.sections.append((name, numpy.ascontiguousarray(array)))
+
+    def add_strings(self, name, values):
+        values = [encode(v) for v in values]
+        offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(v) for v in values])
+        self.add(name + '.offsets', offsets)
+        self.add(name + '.heap', numpy.frombuffer(b''.join(values) or b'\0', dtype=numpy.uint8))
+
+    def write(self, path, **meta):
+        sections = {}
+        offset = 0
+        for name, array in self.sections:
+            sections[name] = (array.dtype.str, list(array.shape), offset)
+            offset = align(offset + array.nbytes)
+        meta.update({ 'format': FORMAT_VERSION, 'sections': sections })
+        header = json.dumps(meta).encode('ascii')
+
+        # Written aside and renamed, so readers never map a partial file
+        tmp_path = path + '.tmp'
+        fd = open(tmp_path, 'wb')
+        fd.write(MAGIC)
+        fd.write(struct.pack('<II', FORMAT_VERSION, len(header)))
+        fd.write(header)
+        base = align(fd.tell())
+        for name, array in self.sections:
+            fd.write(b'\0' * (base + sections[name][2] - fd.tell()))
+            fd.write(array.tobytes())
+        fd.close()
+        os.rename(tmp_path, path)
+
+def export(cursor, path, version=None, tz_grid=None, cell_size=DEFAULT_CELL_SIZE):
+    chunks = dict([(name, []) for name, dtype in GEONAME_COLUMNS])
+    strings = dict([(name, []) for name in GEONAME_STRING_COLUMNS])
+    def flush(rows):
+        for i, (name, dtype) in enumerate(GEONAME_COLUMNS):
+            chunks[name].append(column([r[i] for r in rows], dtype))
+        for i, name in enumerate(GEONAME_STRING_COLUMNS):
+            strings[name].extend([encode(r[len(GEONAME_COLUMNS) + i]) for r in rows])
+
+    rows = []
+    for row in fetch_rows(cursor, GEONAME_SQL):
+        rows.append(row)
+        if len(rows) == CHUNK_SIZE:
+            flush(rows)
+            rows = []
+    flush(rows)
+    columns = dict([(name, numpy.concatenate(chunks[name])) for name, dtype in GEONAME_COLUMNS])
+
+    # Geonames are stored in the order of the spatial index, lookups by
+    # id go through a separate sorted copy of the ids
+    count = len(columns['id'])
+    index = GeoIndex(columns['id'], columns['latitude'], columns['longitude'], cell_size,
+        values=numpy.arange(count))
+    order = index.values
+    writer = SnapshotWriter()
+    for name, dtype in GEONAME_COLUMNS:
+        writer.add('geoname.' + name, columns[name][order])
+    for name in GEONAME_STRING_COLUMNS:
+        writer.add_strings('geoname.' + name, [strings[name][i] for i in order])
+    writer.add('geoname.cell_starts', index.cell_starts)
+    by_id = numpy.argsort(index.ids, kind='mergesort')
+    writer.add('geoname.by_id', by_id)
+    writer.add('geoname.sorted_ids', index.ids[by_id])
+
+    for level in range(1, 5):
+        rows = list(fetch_rows(cursor, 'SELECT id, geoname_id, code FROM admin%d_code ORDER BY id' % level))
+        writer.add('admin%d_code.id' % level, column([r[0] for r in rows], numpy.int32))
+        writer.add('admin%d_code.geoname_id' % level, column([r[1] for r in rows], numpy.int32))
+        writer.add_strings('admin%d_code.code' % level, [r[2] for r in rows])
+
+    rows = list(fetch_rows(cursor, 'SELECT id, name, gmt_offset, dst_offset FROM time_zone ORDER BY id'))
+    writer.add('time_zone.id', column([r[0] for r in rows], numpy.int16))
+    writer.add_strings('time_zone.name', [r[1] for r in rows])
+    writer.add('time_zone.gmt_offset', column([float(r[2]) for r in rows], numpy.float64))
+    writer.add('time_zone.dst_offset', column([float(r[3]) for r in rows], numpy.float64))
+
+    if tz_grid:
+        writer.add('tz_grid', TimezoneGrid.load(tz_grid).grid)
+
+    writer.write(path, version=version, cell_size=cell_size, count=count)
+    return count
+
+class Snapshot(object):
+    def __init__(self, path):
+        fd = open(path, 'rb')
+        try:
+            magic = fd.read(len(MAGIC))
+            format_version, header_length = struct.unpack('<II', fd.read(8))
+            header = json.loads(fd.read(header_length).decode('ascii'))
+        finally:
+            fd.close()
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError('%s is not a version %d geonames snapshot' % (path, FORMAT_VERSION))
+
+        self.path = path
+        self.version = header['version']
+        data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        base = align(len(MAGIC) + 8 + header_length)
+        self.columns = {}
+        for name, (dtype, shape, offset) in header['sections'].items():
+            self.columns[name] = numpy.ndarray(tuple(shape), numpy.dtype(str(dtype)),
+                buffer=data, offset=base + offset)
+
+        geonames = dict([(name, self.columns['geoname.' + name]) for name, dtype in GEONAME_COLUMNS])
+        self.geonames = geonames
+        self.index = GeoIndex.restore(geonames['id'], geonames['latitude'], geonames['longitude'],
+            self.columns['geoname.cell_starts'], header['cell_size'], geonames['timezone_id'])
+        self.tz_grid = None
+        if 'tz_grid' in self.columns:
+            self.tz_grid = TimezoneGrid(self.columns['tz_grid'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def string(self, name, i):
+        offsets = self.columns[name + '.offsets']
+        return self.columns[name + '.heap'][offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def search(self, key, value):
+        # Position of value in a column sorted by key, or None
+        keys = self.columns[key]
+        i = int(numpy.searchsorted(keys, value))
+        if i < len(keys) and keys[i] == value:
+            return i
+        return None
+
+    def position(self, geoname_id):
+        i = self.search('geoname.sorted_ids', geoname_id)
+        if i is None:
+            return None
+        return int(self.columns['geoname.by_id'][i])
+
+    def row(self, position):
+        row = dict([(name, self.string('geoname.' + name, position)) \
+            for name in GEONAME_STRING_COLUMNS])
+        for name, dtype in GEONAME_COLUMNS:
+            value = self.geonames[name][position]
+            if isinstance(value, bytes):
+                value = value.decode('ascii')
+            elif isinstance(value, numpy.floating):
+                value = float(value)
+            else:
+                value = int(value)
+                if value == -1 and name not in NOT_NULL_COLUMNS:
+                    value = None
+            row[name] = value
+        if row['moddate'] is not None:
+            row['moddate'] = date.fromordinal(row['moddate'])
+        return row
+
+    def get(self, geoname_id):
+        position = self.position(geoname_id)
+        if position is None:
+            return None
+        return self.row(position)
+
+    def get_many(self, geoname_ids):
+        rows = {}
+        for geoname_id in geoname_ids:
+            position = self.position(geoname_id)
+            if position is not None:
+                rows[geoname_id] = self.row(position)
+        return rows
+
+    def hierarchy(self, geoname_id):
+        # Ancestors from the parent up, like Geoname.hierarchy
+        rows = []
+        position = self.position(geoname_id)
+        while position is not None and len(rows) < MAX_ANCESTOR_DEPTH:
+            parent_id = int(self.geonames['parent_id'][position])
+            if parent_id == -1:
+                break
+            position = self.position(parent_id)
+            if position is not None:
+                rows.append(self.row(position))
+        return rows
+
+    def near_point(self, latitude, longitude, kms, order=True, excluded=(), limit=None,
+            fclasses=None, fcodes=None, min_population=None):
+        positions, distances = self.index.within(latitude, longitude, kms, order)
+        mask = numpy.ones(len(positions), dtype=bool)
+        if excluded:
+            mask &= ~numpy.isin(self.geonames['fcode'][positions], [encode(x) for x in excluded])
+        if fclasses:
+            mask &= numpy.isin(self.geonames['fclass'][positions], [encode(x) for x in fclasses])
+        if fcodes:
+            mask &= numpy.isin(self.geonames['fcode'][positions], [encode(x) for x in fcodes])
+        if min_population:
+            mask &= self.geonames['population'][positions] >= min_population
+        positions = positions[mask][:limit]
+        distances = distances[mask][:limit]
+        return [(self.row(p), d * 1000) for p, d in zip(positions, distances)]
+
+    def admin_code(self, level, admin_id):
+        table = 'admin%d_code' % level
+        i = self.search(table + '.id', admin_id)
+        if i is None:
+            return None
+        return {
+            'id': admin_id,
+            'geoname_id': int(self.columns[table + '.geoname_id'][i]),
+            'code': self.string(table + '.code', i),
+        }
+
+    def timezone(self, timezone_id):
+        i = self.search('time_zone.id', timezone_id)
+        if i is None:
+            return None
+        return {
+            'id': timezone_id,
+            'name': self.string('time_zone.name', i),
+            'gmt_offset': float(self.columns['time_zone.gmt_offset'][i]),
+            'dst_offset': float(self.columns['time_zone.dst_offset'][i]),
+        }
+
+    def aprox_tz(self, latitude, longitude):
+        if self.tz_grid is not None:
+            timezone_id = self.tz_grid.lookup(latitude, longitude)
+            return timezone_id and self.timezone(timezone_id)
+
+        # Same search as GeonameGISHelper.aprox_tz
+        flat = float(latitude)
+        flng = float(longitude)
+        for diff in (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1):
+            positions = self.index.within_box(flat - diff * 10, flat + diff * 10, flng - diff, flng + diff)
+            timezones = self.index.values[positions]
+            timezones = timezones[timezones != -1]
+            if len(timezones):
+                return self.timezone(int(timezones[0]))
+        return None
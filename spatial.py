@@ -0,0 +1,193 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+from math import asin, cos, degrees, pi, radians, sin
+
+import numpy
+
+# Same radius used by Geoname.distance_points
+EARTH_RADIUS = 6378.7
+
+DEFAULT_CELL_SIZE = 0.25
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = [numpy.radians(numpy.asarray(x, dtype=numpy.float64)) \
+        for x in (lat1, lng1, lat2, lng2)]
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + \
+        numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+def distances_from(latitude, longitude, latitudes, longitudes):
+    return haversine(latitude, longitude, latitudes, longitudes)
+
+def distance_matrix(latitudes1, longitudes1, latitudes2, longitudes2):
+    latitudes1 = numpy.asarray(latitudes1, dtype=numpy.float64)[:, numpy.newaxis]
+    longitudes1 = numpy.asarray(longitudes1, dtype=numpy.float64)[:, numpy.newaxis]
+    return haversine(latitudes1, longitudes1, latitudes2, longitudes2)
+
+class GeoIndex(object):
+    # Points are bucketed in a regular latitude/longitude grid and stored
+    # sorted by cell, so each row of cells touched by a query is a single
+    # contiguous slice of the arrays.
+    def __init__(self, ids, latitudes, longitudes, cell_size=DEFAULT_CELL_SIZE, values=None):
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        self.cell_size = cell_size
+        self.nrows = int(numpy.ceil(180.0 / cell_size))
+        self.ncols = int(numpy.ceil(360.0 / cell_size))
+        cells = self.cells(latitudes, longitudes)
+        order = numpy.argsort(cells, kind='mergesort')
+        self.ids = ids[order]
+        self.latitudes = latitudes[order]
+        self.longitudes = longitudes[order]
+        self.values = None
+        if values is not None:
+            self.values = numpy.asarray(values)[order]
+        self.cell_starts = numpy.searchsorted(cells[order],
+            numpy.arange(self.nrows * self.ncols + 1)).astype(numpy.int64)
+
+    @classmethod
+    def restore(cls, ids, latitudes, longitudes, cell_starts, cell_size=DEFAULT_CELL_SIZE, values=None):
+        # Arrays already sorted by cell (e.g. memory mapped from a
+        # snapshot) are used as they are, without copying them
+        index = cls.__new__(cls)
+        index.cell_size = cell_size
+        index.nrows = int(numpy.ceil(180.0 / cell_size))
+        index.ncols = int(numpy.ceil(360.0 / cell_size))
+        index.ids = ids
+        index.latitudes = latitudes
+        index.longitudes = longitudes
+        index.values = values
+        index.cell_starts = cell_starts
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows_cols(self, latitudes, longitudes):
+        rows = numpy.floor((numpy.asarray(latitudes) + 90.0) / self.cell_size).astype(numpy.int64)
+        cols = numpy.floor((numpy.asarray(longitudes) + 180.0) / self.cell_size).astype(numpy.int64)
+        return numpy.clip(rows, 0, self.nrows - 1), cols % self.ncols
+
+    def cells(self, latitudes, longitudes):
+        rows, cols = self.rows_cols(latitudes, longitudes)
+        return rows * self.ncols + cols
+
+    def box_positions(self, minlat, maxlat, minlng, maxlng):
+        r0, c0 = self.rows_cols(max(minlat, -90.0), minlng)
+        r1, c1 = self.rows_cols(min(maxlat, 90.0), maxlng)
+        if maxlng - minlng >= 360.0:
+            spans = [(0, self.ncols - 1)]
+        elif c0 <= c1:
+            spans = [(c0, c1)]
+        else:
+            spans = [(c0, self.ncols - 1), (0, c1)]
+        slices = []
+        for row in range(int(r0), int(r1) + 1):
+            base = row * self.ncols
+            for first, last in spans:
+                start = self.cell_starts[base + first]
+                end = self.cell_starts[base + last + 1]
+                if end > start:
+                    slices.append(numpy.arange(start, end))
+        if not slices:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(slices)
+
+    def within_box(self, minlat, maxlat, minlng, maxlng):
+        positions = self.box_positions(minlat, maxlat, minlng, maxlng)
+        lats = self.latitudes[positions]
+        lngs = (self.longitudes[positions] - minlng) % 360.0
+        mask = (lats >= minlat) & (lats <= maxlat) & (lngs <= maxlng - minlng)
+        return positions[mask]
+
+    def radius_box(self, latitude, longitude, kms):
+        angle = kms / EARTH_RADIUS
+        if angle >= pi:
+            return -90.0, 90.0, -180.0, 180.0
+        dlat = degrees(angle)
+        minlat = latitude - dlat
+        maxlat = latitude + dlat
+        if minlat <= -90.0 or maxlat >= 90.0:
+            return max(minlat, -90.0), min(maxlat, 90.0), -180.0, 180.0
+        ratio = sin(angle) / cos(radians(latitude))
+        if ratio >= 1:
+            return minlat, maxlat, -180.0, 180.0
+        dlng = degrees(asin(ratio))
+        return minlat, maxlat, longitude - dlng, longitude + dlng
+
+    def within(self, latitude, longitude, kms, order=True):
+        latitude = float(latitude)
+        longitude = float(longitude)
+        positions = self.box_positions(*self.radius_box(latitude, longitude, kms))
+        distances = haversine(latitude, longitude,
+            self.latitudes[positions], self.longitudes[positions])
+        mask = distances <= kms
+        positions = positions[mask]
+        distances = distances[mask]
+        if order:
+            idx = numpy.argsort(distances, kind='mergesort')
+            positions = positions[idx]
+            distances = distances[idx]
+        return positions, distances
+
+    def nearest(self, latitude, longitude, k, max_kms=None):
+        if max_kms is None:
+            max_kms = pi * EARTH_RADIUS
+        kms = min(max(self.cell_size * 111.0, 1.0), max_kms)
+        while True:
+            positions, distances = self.within(latitude, longitude, kms)
+            if len(positions) >= k or kms >= max_kms:
+                return positions[:k], distances[:k]
+            kms = min(kms * 2, max_kms)
+
+class TimezoneGrid(object):
+    # A raster of time zone ids (0 meaning unknown), filled from the
+    # geonames with a timezone_id and then grown into the empty
+    # neighbouring cells, so a lookup is a single array access.
+    def __init__(self, grid):
+        self.grid = grid
+        self.nrows, self.ncols = grid.shape
+        self.cell_size = 180.0 / self.nrows
+
+    @classmethod
+    def build(cls, latitudes, longitudes, timezones, cell_size=0.1, fill_steps=10):
+        nrows = int(numpy.ceil(180.0 / cell_size))
+        ncols = int(numpy.ceil(360.0 / cell_size))
+        grid = numpy.zeros((nrows, ncols), dtype=numpy.int16)
+        rows = numpy.floor((numpy.asarray(latitudes, dtype=numpy.float64) + 90.0) / cell_size).astype(numpy.int64)
+        cols = numpy.floor((numpy.asarray(longitudes, dtype=numpy.float64) + 180.0) / cell_size).astype(numpy.int64)
+        grid[numpy.clip(rows, 0, nrows - 1), cols % ncols] = timezones
+        for step in range(fill_steps):
+            empty = grid == 0
+            if not empty.any():
+                break
+            filled = numpy.zeros_like(grid)
+            up = numpy.zeros_like(grid)
+            up[1:] = grid[:-1]
+            down = numpy.zeros_like(grid)
+            down[:-1] = grid[1:]
+            for neighbour in (up, down, numpy.roll(grid, 1, axis=1), numpy.roll(grid, -1, axis=1)):
+                filled = numpy.where(filled == 0, neighbour, filled)
+            grid = numpy.where(empty, filled, grid)
+        return cls(grid)
+
+    @classmethod
+    def load(cls, path):
+        return cls(numpy.load(path, mmap_mode='r'))
+
+    def save(self, path):
+        fd = open(path, 'wb')
+        numpy.save(fd, numpy.ascontiguousarray(self.grid))
+        fd.close()
+
+    def lookup_many(self, latitudes, longitudes):
+        rows = numpy.floor((numpy.asarray(latitudes, dtype=numpy.float64) + 90.0) / self.cell_size).astype(numpy.int64)
+        cols = numpy.floor((numpy.asarray(longitudes, dtype=numpy.float64) + 180.0) / self.cell_size).astype(numpy.int64)
+        return self.grid[numpy.clip(rows, 0, self.nrows - 1), cols % self.ncols]
+
+    def lookup(self, latitude, longitude):
+        tz = int(self.lookup_many([float(latitude)], [float(longitude)])[0])
+        return tz or None
@@ -0,0 +1,249 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Set-based loading of geonames dump lines. Lines are streamed with COPY
+# into temporary staging tables (dropped on commit) and applied to the
+# real tables with a few statements, so the daily updates don't need a
+# query per line. Like denorm, everything works on a plain DB-API cursor.
+
+from itertools import islice
+from cStringIO import StringIO
+
+from denorm import ID_CHUNK_SIZE, ancestor_ids, descendant_ids
+
+STAGE_CHUNK_SIZE = 10000
+
+GEONAME_STAGING_COLUMNS = ('id', 'name', 'ascii_name', 'latitude', 'longitude',
+    'fclass', 'fcode', 'country_code', 'cc2', 'admin1_code', 'admin2_code',
+    'admin3_code', 'admin4_code', 'population', 'elevation', 'gtopo30',
+    'timezone_name', 'moddate')
+
+ALTERNATE_NAME_STAGING_COLUMNS = ('id', 'geoname_id', 'language', 'name', 'preferred', 'short')
+
+# Everything but the ids is kept as text and converted when applied
+STAGING_TABLE_SQL = 'CREATE TEMPORARY TABLE %(table)s (seq SERIAL, %(columns)s) ON COMMIT DROP'
+
+# A file may list the same record more than once, the last line wins
+DEDUPLICATE_SQL = 'DELETE FROM %(table)s s USING %(table)s t WHERE t.id = s.id AND t.seq > s.seq'
+
+ADMIN_JOINS_SQL = '''LEFT JOIN admin1_code a1 ON s.admin1_code <> ''
+        AND a1.country_id = s.country_code AND a1.code = s.admin1_code
+    LEFT JOIN admin2_code a2 ON s.admin2_code <> ''
+        AND a2.country_id = s.country_code AND a2.admin1_id IS NOT DISTINCT FROM a1.id
+        AND a2.code = s.admin2_code
+    LEFT JOIN admin3_code a3 ON s.admin3_code <> ''
+        AND a3.country_id = s.country_code AND a3.admin1_id IS NOT DISTINCT FROM a1.id
+        AND a3.admin2_id IS NOT DISTINCT FROM a2.id AND a3.code = s.admin3_code
+    LEFT JOIN admin4_code a4 ON s.admin4_code <> ''
+        AND a4.country_id = s.country_code AND a4.admin1_id IS NOT DISTINCT FROM a1.id
+        AND a4.admin2_id IS NOT DISTINCT FROM a2.id AND a4.admin3_id IS NOT DISTINCT FROM a3.id
+        AND a4.code = s.admin4_code'''
+
+UPDATE_ADMIN_SQL = '''UPDATE admin%(level)d_code a SET name = s.name, ascii_name = s.ascii_name,
+    country_id = s.country_code, code = s.admin%(level)d_code
+FROM geoname_staging s WHERE s.fcode = 'ADM%(level)d' AND a.geoname_id = s.id'''
+
+INSERT_ADMIN_SQL = '''INSERT INTO admin%(level)d_code (country_id, geoname_id, code, name, ascii_name%(parent_columns)s)
+SELECT DISTINCT ON (s.id) s.country_code, s.id, s.admin%(level)d_code, s.name, s.ascii_name%(parent_values)s
+FROM geoname_staging s
+    %(joins)s
+WHERE s.fcode = 'ADM%(level)d' AND NOT EXISTS (SELECT 1 FROM admin%(level)d_code a WHERE a.geoname_id = s.id)
+ORDER BY s.id%(parent_values)s'''
+
+UPSERT_GEONAME_SQL = '''INSERT INTO geoname (id, name, ascii_name, latitude, longitude, fclass, fcode,
+    country_id, cc2, admin1_id, admin2_id, admin3_id, admin4_id, population, elevation,
+    gtopo30, timezone_id, moddate)
+SELECT DISTINCT ON (s.id) s.id, s.name, s.ascii_name, CAST(s.latitude AS NUMERIC),
+    CAST(s.longitude AS NUMERIC), s.fclass, s.fcode, s.country_code, s.cc2,
+    a1.id, a2.id, a3.id, a4.id,
+    COALESCE(CAST(NULLIF(s.population, '') AS INTEGER), 0),
+    COALESCE(CAST(NULLIF(s.elevation, '') AS INTEGER), 0),
+    COALESCE(CAST(NULLIF(s.gtopo30, '') AS INTEGER), 0),
+    tz.id, CAST(s.moddate AS DATE)
+FROM geoname_staging s
+    %(joins)s
+    LEFT JOIN time_zone tz ON tz.name = s.timezone_name
+ORDER BY s.id, a1.id, a2.id, a3.id, a4.id, tz.id
+ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, ascii_name = EXCLUDED.ascii_name,
+    latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude, fclass = EXCLUDED.fclass,
+    fcode = EXCLUDED.fcode, country_id = EXCLUDED.country_id, cc2 = EXCLUDED.cc2,
+    admin1_id = EXCLUDED.admin1_id, admin2_id = EXCLUDED.admin2_id,
+    admin3_id = EXCLUDED.admin3_id, admin4_id = EXCLUDED.admin4_id,
+    population = EXCLUDED.population, elevation = EXCLUDED.elevation,
+    gtopo30 = EXCLUDED.gtopo30, timezone_id = EXCLUDED.timezone_id, moddate = EXCLUDED.moddate'''
+
+# Names of unknown geonames are skipped instead of breaking the foreign key
+UPSERT_ALTERNATE_NAME_SQL = '''INSERT INTO alternate_name (id, geoname_id, language, name, preferred, short)
+SELECT s.id, s.geoname_id, s.language, s.name,
+    COALESCE(s.preferred = '1', FALSE), COALESCE(s.short = '1', FALSE)
+FROM alternate_name_staging s
+WHERE EXISTS (SELECT 1 FROM geoname g WHERE g.id = s.geoname_id)
+ON CONFLICT (id) DO UPDATE SET geoname_id = EXCLUDED.geoname_id, language = EXCLUDED.language,
+    name = EXCLUDED.name, preferred = EXCLUDED.preferred, short = EXCLUDED.short'''
+
+# Staged geonames left out by the filters, unless they're already in the
+# database or a country or continent points to them
+FILTER_STAGED_GEONAMES_SQL = '''DELETE FROM geoname_staging s
+WHERE NOT (%(condition)s)
+    AND NOT EXISTS (SELECT 1 FROM geoname g WHERE g.id = s.id)
+    AND NOT EXISTS (SELECT 1 FROM country c WHERE c.geoname_id = s.id)
+    AND NOT EXISTS (SELECT 1 FROM continent c WHERE c.geoname_id = s.id)'''
+
+# Rows which reference the deleted geonames and go away with them, the
+# admin codes are handled apart since geonames point to them in turn
+GEONAME_DEPENDENTS_SQL = (
+    'DELETE FROM alternate_name WHERE geoname_id = ANY(%s)',
+    'DELETE FROM geoname_i18n_name WHERE geoname_id = ANY(%s)',
+    'DELETE FROM geoname_ancestor WHERE geoname_id = ANY(%s) OR ancestor_id = ANY(%s)',
+    'DELETE FROM geoname_child WHERE parent_id = ANY(%s) OR child_id = ANY(%s)',
+)
+
+# Deleted geonames a country or continent still points to, they're kept
+# like the staged ones FILTER_STAGED_GEONAMES_SQL keeps
+REFERENCED_GEONAMES_SQL = '''SELECT geoname_id FROM country WHERE geoname_id = ANY(%s)
+UNION SELECT geoname_id FROM continent WHERE geoname_id = ANY(%s)'''
+
+def parse_geoname(line):
+    # Drops the alternatenames column, which is the bulk of each line
+    # and is never loaded (alternate names come from their own dump)
+    fields = line.split('\t')
+    return tuple(fields[:3] + fields[4:19])
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    chunk = list(islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, size))
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_line(row):
+    return '\t'.join([copy_value(v) for v in row]) + '\n'
+
+def create_staging_table(cursor, table, columns, integers=('id',)):
+    cursor.execute(STAGING_TABLE_SQL % {
+        'table': table,
+        'columns': ', '.join(['%s %s' % (c, c in integers and 'INTEGER' or 'TEXT') for c in columns]),
+    })
+
+def stage(cursor, table, columns, rows, chunk_size=STAGE_CHUNK_SIZE):
+    count = 0
+    for chunk in chunks(rows, chunk_size):
+        cursor.copy_from(StringIO(''.join([copy_line(row) for row in chunk])), table, columns=columns)
+        count += len(chunk)
+    cursor.execute(DEDUPLICATE_SQL % { 'table': table })
+    return count
+
+def dump_lines(fd):
+    for line in fd:
+        line = line.rstrip('\r\n')
+        if line:
+            yield line
+
+def staged_ids(cursor, table, column='id'):
+    cursor.execute('SELECT DISTINCT %s FROM %s' % (column, table))
+    return set([row[0] for row in cursor.fetchall()])
+
+def admin_sql(level):
+    parents = ['admin%d_id' % i for i in range(1, level)]
+    return INSERT_ADMIN_SQL % {
+        'level': level,
+        'joins': ADMIN_JOINS_SQL,
+        'parent_columns': ''.join([', %s' % p for p in parents]),
+        'parent_values': ''.join([', a%d.id' % i for i in range(1, level)]),
+    }
+
+def stage_geonames(cursor, fd, geoname_filter=None):
+    create_staging_table(cursor, 'geoname_staging', GEONAME_STAGING_COLUMNS)
+    rows = (parse_geoname(line) for line in dump_lines(fd))
+    count = stage(cursor, 'geoname_staging', GEONAME_STAGING_COLUMNS, rows)
+    # Same cleanup the importer does for geonames without a country
+    cursor.execute('UPDATE geoname_staging SET country_code = TRIM(country_code)')
+    if geoname_filter is not None and geoname_filter.filters_geonames():
+        condition, params = geoname_filter.staged_geoname_sql()
+        cursor.execute(FILTER_STAGED_GEONAMES_SQL % { 'condition': condition }, params)
+        count -= cursor.rowcount
+    return count
+
+def apply_geonames(cursor):
+    # Returns the ids of the geonames whose ancestor paths or children
+    # may have changed: the staged ones and their old ancestors
+    geoname_ids = staged_ids(cursor, 'geoname_staging')
+    touched = set(geoname_ids)
+    touched.update(ancestor_ids(cursor, geoname_ids))
+    # The admin codes are applied from the top level down, so a new
+    # ADM2 can already reference the ADM1 staged along with it
+    for level in range(1, 5):
+        cursor.execute(UPDATE_ADMIN_SQL % { 'level': level })
+        cursor.execute(admin_sql(level))
+    cursor.execute(UPSERT_GEONAME_SQL % { 'joins': ADMIN_JOINS_SQL })
+    return touched
+
+def stage_alternate_names(cursor, fd, geoname_filter=None):
+    create_staging_table(cursor, 'alternate_name_staging', ALTERNATE_NAME_STAGING_COLUMNS,
+        ('id', 'geoname_id'))
+    rows = (line.split('\t')[:6] for line in dump_lines(fd))
+    if geoname_filter is not None and geoname_filter.filters_alternate_names():
+        rows = (row for row in rows if geoname_filter.keep_alternate_name(row[2]))
+    return stage(cursor, 'alternate_name_staging', ALTERNATE_NAME_STAGING_COLUMNS, rows)
+
+def apply_alternate_names(cursor):
+    # Returns the ids of the geonames which gained or lost a name
+    geoname_ids = staged_ids(cursor, 'alternate_name_staging', 'geoname_id')
+    cursor.execute('SELECT DISTINCT a.geoname_id FROM alternate_name a ' \
+        'JOIN alternate_name_staging s ON s.id = a.id')
+    geoname_ids.update([row[0] for row in cursor.fetchall()])
+    cursor.execute(UPSERT_ALTERNATE_NAME_SQL)
+    return geoname_ids
+
+def delete_admin_codes(cursor, geoname_ids):
+    # Geonames (and lower level codes) inside a deleted division are
+    # kept, they just stop pointing to it
+    for level in range(4, 0, -1):
+        cursor.execute('SELECT id FROM admin%d_code WHERE geoname_id = ANY(%%s)' % level, (geoname_ids,))
+        code_ids = [row[0] for row in cursor.fetchall()]
+        if not code_ids:
+            continue
+        cursor.execute('UPDATE geoname SET admin%d_id = NULL WHERE admin%d_id = ANY(%%s)' % \
+            (level, level), (code_ids,))
+        for lower in range(level + 1, 5):
+            cursor.execute('UPDATE admin%d_code SET admin%d_id = NULL WHERE admin%d_id = ANY(%%s)' % \
+                (lower, level, level), (code_ids,))
+        cursor.execute('DELETE FROM admin%d_code WHERE id = ANY(%%s)' % level, (code_ids,))
+
+def delete_geonames(cursor, lines):
+    # Returns the ids of the geonames whose ancestor paths or children
+    # may have changed: the deleted ones, their ancestors and descendants
+    touched = set()
+    for chunk in chunks(lines, ID_CHUNK_SIZE):
+        geoname_ids = [int(line.split('\t', 1)[0]) for line in chunk]
+        cursor.execute(REFERENCED_GEONAMES_SQL, (geoname_ids, geoname_ids))
+        referenced = set([row[0] for row in cursor.fetchall()])
+        for geoname_id in sorted(referenced):
+            print 'Geoname %d is referenced by a country or continent, not deleted' % geoname_id
+        geoname_ids = [x for x in geoname_ids if x not in referenced]
+        if not geoname_ids:
+            continue
+        touched.update(geoname_ids)
+        touched.update(ancestor_ids(cursor, geoname_ids))
+        touched.update(descendant_ids(cursor, geoname_ids))
+        for sql in GEONAME_DEPENDENTS_SQL:
+            cursor.execute(sql, (geoname_ids,) * sql.count('%s'))
+        delete_admin_codes(cursor, geoname_ids)
+        cursor.execute('DELETE FROM geoname WHERE id = ANY(%s)', (geoname_ids,))
+    return touched
+
+def delete_alternate_names(cursor, lines):
+    # Returns the ids of the geonames which lost a name
+    geoname_ids = set()
+    for chunk in chunks(lines, ID_CHUNK_SIZE):
+        name_ids = [int(line.split('\t', 1)[0]) for line in chunk]
+        cursor.execute('DELETE FROM alternate_name WHERE id = ANY(%s) RETURNING geoname_id', (name_ids,))
+        geoname_ids.update([row[0] for row in cursor.fetchall()])
+    return geoname_ids
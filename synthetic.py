@@ -0,0 +1,207 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# Generates a small, deterministic fake of the geonames dump files, in
+# the same formats geonames-import reads, so imports and queries can be
+# measured without downloading the real (multi gigabyte) dump.
+
+import os
+import random
+from string import ascii_uppercase
+
+GLOBE = (6295630, 'Earth')
+
+# Must match the continents hardcoded in geonames-import
+CONTINENTS = (
+    ('AF', 'Africa', 6255146, 7.2, 21.1),
+    ('AS', 'Asia', 6255147, 29.8, 94.2),
+    ('EU', 'Europe', 6255148, 48.7, 9.1),
+    ('NA', 'North America', 6255149, 46.1, -100.5),
+    ('OC', 'Oceania', 6255151, -18.3, 138.5),
+    ('SA', 'South America', 6255150, -14.6, -57.6),
+    ('AN', 'Antarctica', 6255152, -78.2, 16.4),
+)
+
+LANGUAGES = (
+    ('eng', 'eng', 'en', 'English'),
+    ('spa', 'spa', 'es', 'Spanish'),
+    ('fra', 'fre', 'fr', 'French'),
+    ('deu', 'ger', 'de', 'German'),
+    ('ita', 'ita', 'it', 'Italian'),
+)
+
+FEATURE_CODES = (
+    ('L.AREA', 'area', ''),
+    ('L.CONT', 'continent', ''),
+    ('A.PCLI', 'independent political entity', ''),
+    ('A.ADM1', 'first-order administrative division', ''),
+    ('A.ADM2', 'second-order administrative division', ''),
+    ('A.ADM3', 'third-order administrative division', ''),
+    ('A.ADM4', 'fourth-order administrative division', ''),
+    ('P.PPLC', 'capital of a political entity', ''),
+    ('P.PPL', 'populated place', ''),
+)
+
+ADMIN_LEVELS = ('ADM1', 'ADM2', 'ADM3', 'ADM4')
+
+# Countries, divisions per parent for each admin level and places
+DEFAULT_COUNTRIES = 10
+DEFAULT_FANOUT = (5, 4, 2, 2)
+DEFAULT_PLACES = 10000
+DEFAULT_ALTNAMES = 2
+
+FIRST_GEONAME_ID = 1000000
+MODDATE = '2008-01-01'
+
+SYLLABLES = ('ba', 'ca', 'da', 'el', 'fo', 'gu', 'ha', 'in', 'jo', 'ka', 'lu', 'ma',
+    'ne', 'or', 'pi', 'qu', 'ro', 'sa', 'ti', 'ur', 'va', 'wi', 'xe', 'yo', 'zu')
+
+def country_codes(count):
+    # CS is skipped by the importer (it's a deprecated code)
+    codes = []
+    for first in ascii_uppercase:
+        for second in ascii_uppercase:
+            if first + second != 'CS':
+                codes.append(first + second)
+    return codes[:count]
+
+def timezone_name(offset):
+    return 'Synthetic/UTC%+d' % offset
+
+def timezone_offset(longitude):
+    return max(-12, min(14, int(round(longitude / 15.0))))
+
+class Generator(object):
+    def __init__(self, countries=DEFAULT_COUNTRIES, fanout=DEFAULT_FANOUT,
+            places=DEFAULT_PLACES, altnames=DEFAULT_ALTNAMES, seed=0):
+        self.countries = countries
+        self.fanout = fanout
+        self.places = places
+        self.altnames = altnames
+        self.random = random.Random(seed)
+        self.next_id = FIRST_GEONAME_ID
+        self.next_altname_id = 1
+        self.geonames = []
+
+    def name(self):
+        return ''.join([self.random.choice(SYLLABLES) \
+            for i in range(self.random.randint(2, 4))]).capitalize()
+
+    def geoname(self, name, latitude, longitude, fclass, fcode, country='',
+            admin=('', '', '', ''), population=0, geoname_id=None):
+        if geoname_id is None:
+            geoname_id = self.next_id
+            self.next_id += 1
+        latitude = max(-89.9, min(89.9, latitude))
+        longitude = (longitude + 180.0) % 360.0 - 180.0
+        record = (geoname_id, name, latitude, longitude, fclass, fcode, country,
+            admin, population, timezone_name(timezone_offset(longitude)))
+        self.geonames.append(record)
+        return record
+
+    def point_near(self, latitude, longitude, spread):
+        return (latitude + self.random.uniform(-spread, spread),
+            longitude + self.random.uniform(-spread, spread))
+
+    def build(self):
+        self.geoname(GLOBE[1], 0.0, 0.0, 'L', 'AREA', geoname_id=GLOBE[0])
+        for code, name, geoname_id, latitude, longitude in CONTINENTS:
+            self.geoname(name, latitude, longitude, 'L', 'CONT', geoname_id=geoname_id)
+
+        self.country_records = []
+        self.admin_records = dict([(level, []) for level in ADMIN_LEVELS])
+        leaves = []
+        for i, code in enumerate(country_codes(self.countries)):
+            continent = CONTINENTS[i % len(CONTINENTS)]
+            latitude, longitude = self.point_near(continent[3], continent[4], 20)
+            country = self.geoname(self.name(), latitude, longitude, 'A', 'PCLI', code,
+                population=self.random.randint(100000, 100000000))
+            self.country_records.append((code, continent[0], country))
+            parents = [((), latitude, longitude)]
+            for depth, level in enumerate(ADMIN_LEVELS):
+                children = []
+                spread = 5.0 / (depth + 1)
+                for codes, plat, plng in parents:
+                    for j in range(self.fanout[depth]):
+                        admin = codes + ('%02d' % (j + 1),)
+                        alat, alng = self.point_near(plat, plng, spread)
+                        record = self.geoname(self.name(), alat, alng, 'A', level, code,
+                            admin + ('',) * (4 - len(admin)),
+                            self.random.randint(1000, 1000000))
+                        self.admin_records[level].append(record)
+                        children.append((admin, alat, alng))
+                parents = children
+            leaves.extend([(code, codes, plat, plng) for codes, plat, plng in parents])
+
+        for i in range(self.places):
+            code, codes, latitude, longitude = self.random.choice(leaves)
+            latitude, longitude = self.point_near(latitude, longitude, 0.5)
+            self.geoname(self.name(), latitude, longitude, 'P', i < self.countries and 'PPLC' or 'PPL',
+                code, codes, int(self.random.paretovariate(1.2) * 100))
+
+    def write(self, directory):
+        if not self.geonames:
+            self.build()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = lambda name: os.path.join(directory, name)
+
+        fd = open(path('featureCodes.txt'), 'w')
+        for code in FEATURE_CODES:
+            fd.write('\t'.join(code) + '\n')
+        fd.close()
+
+        fd = open(path('iso-languagecodes.txt'), 'w')
+        fd.write('ISO 639-3\tISO 639-2\tISO 639-1\tLanguage Name\n')
+        for language in LANGUAGES:
+            fd.write('\t'.join(language) + '\n')
+        fd.close()
+
+        fd = open(path('timeZones.txt'), 'w')
+        fd.write('TimeZoneId\tGMT offset 1. Jan 2008\tDST offset 1. Jul 2008\n')
+        for offset in range(-12, 15):
+            fd.write('%s\t%.1f\t%.1f\n' % (timezone_name(offset), offset, offset))
+        fd.close()
+
+        fd = open(path('countryInfo.txt'), 'w')
+        fd.write('# Synthetic country info\n')
+        for i, (code, continent, record) in enumerate(self.country_records):
+            fd.write('\t'.join([code, code + 'X', str(i + 1), code, record[1], '', '1000',
+                str(record[8]), continent, '.' + code.lower(), 'EUR', 'Euro', '', '', '',
+                'en', str(record[0])]) + '\n')
+        fd.close()
+
+        fd = open(path('admin1CodesASCII.txt'), 'w')
+        for record in self.admin_records['ADM1']:
+            fd.write('%s.%s\t%s\t%s\t%d\n' % (record[6], record[7][0], record[1], record[1], record[0]))
+        fd.close()
+
+        fd = open(path('admin2Codes.txt'), 'w')
+        for record in self.admin_records['ADM2']:
+            fd.write('%s.%s.%s\t%s\t%s\t%d\n' % (record[6], record[7][0], record[7][1],
+                record[1], record[1], record[0]))
+        fd.close()
+
+        geonames = open(path('allCountries.txt'), 'w')
+        altnames = open(path('alternateNames.txt'), 'w')
+        for geoname_id, name, latitude, longitude, fclass, fcode, country, admin, \
+                population, timezone in self.geonames:
+            names = []
+            for i in range(self.altnames):
+                language = self.random.choice(LANGUAGES)[2]
+                altname = self.name()
+                names.append(altname)
+                altnames.write('%d\t%d\t%s\t%s\t%s\t\n' % (self.next_altname_id, geoname_id,
+                    language, altname, i == 0 and '1' or ''))
+                self.next_altname_id += 1
+            geonames.write('\t'.join([str(geoname_id), name, name, ','.join(names),
+                '%.5f' % latitude, '%.5f' % longitude, fclass, fcode, country, ''] +
+                list(admin) + [str(population), '', str(self.random.randint(0, 3000)),
+                timezone, MODDATE]) + '\n')
+        geonames.close()
+        altnames.close()
+        return len(self.geonames)
+
+def generate(directory, **kwargs):
+    return Generator(**kwargs).write(directory)
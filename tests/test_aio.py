@@ -0,0 +1,210 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# aio.py needs Python 3.5+, these tests are skipped by older versions
+# (they're written without async syntax, so Python 2 can still load them
+# when it discovers the others). Run from the application directory with
+#
+#     python3 -m unittest tests.test_aio
+#
+# The unit tests answer the queries with a fake fetch(), so neither
+# asyncpg nor PostgreSQL are needed. The integration tests need asyncpg
+# and GEONAMES_TEST_DSN, the postgresql:// URI of a scratch database,
+# where they create and drop a geonames_aio_test schema.
+
+import os
+import sys
+import types
+import unittest
+
+SUPPORTED = sys.version_info >= (3, 5)
+TEST_DSN = os.environ.get('GEONAMES_TEST_DSN')
+TEST_SCHEMA = 'geonames_aio_test'
+
+if SUPPORTED:
+    import asyncio
+
+    try:
+        import asyncpg
+    except ImportError:
+        # aio only needs asyncpg to create the pool, which the unit tests
+        # don't
+        asyncpg = None
+        sys.modules['asyncpg'] = types.ModuleType('asyncpg')
+
+    import aio
+
+    class FakeGeonames(aio.AsyncGeonames):
+        def __init__(self, names, i18n_names, i18n_languages=()):
+            super(FakeGeonames, self).__init__(None, i18n_languages)
+            self.names = names
+            self.i18n_names = i18n_names
+            self.queries = []
+
+        def fetch(self, sql, *args):
+            self.queries.append(sql)
+            if sql == aio.I18N_NAMES_SQL or sql == aio.ALTERNATE_NAMES_SQL:
+                lang, ids = args
+                rows = [(x, self.i18n_names[(x, lang)]) for x in ids if (x, lang) in self.i18n_names]
+            else:
+                rows = [(x, self.names[x]) for x in args[0] if x in self.names]
+            return later(0, rows)
+
+def later(delay, result=None, error=None):
+    # A future resolved after delay seconds, standing in for a query
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    if error is not None:
+        loop.call_later(delay, future.set_exception, error)
+    else:
+        loop.call_later(delay, future.set_result, result)
+    return future
+
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+@unittest.skipIf(not SUPPORTED, 'aio needs Python 3.5+')
+class CoalescerTest(AsyncTestCase):
+    def test_concurrent_lookups_share_a_query(self):
+        coalescer = aio.Coalescer()
+        calls = []
+        def lookup():
+            calls.append(1)
+            return later(0.01, {'id': 1})
+        results = self.run_async(asyncio.gather(*[coalescer.run('key', lookup) for i in range(10)]))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(coalescer.pending, {})
+
+    def test_lookups_after_completion_run_again(self):
+        coalescer = aio.Coalescer()
+        calls = []
+        def lookup():
+            calls.append(1)
+            return later(0, len(calls))
+        self.assertEqual(self.run_async(coalescer.run('key', lookup)), 1)
+        self.assertEqual(self.run_async(coalescer.run('key', lookup)), 2)
+
+    def test_cancelled_caller_does_not_cancel_the_others(self):
+        coalescer = aio.Coalescer()
+        lookup = lambda: later(0.01, 'done')
+        first = asyncio.ensure_future(coalescer.run('key', lookup))
+        second = asyncio.ensure_future(coalescer.run('key', lookup))
+        self.run_async(asyncio.sleep(0))
+        first.cancel()
+        self.assertEqual(self.run_async(second), 'done')
+        self.assertTrue(first.cancelled())
+
+    def test_errors_reach_every_caller(self):
+        coalescer = aio.Coalescer()
+        lookup = lambda: later(0.01, error=ValueError('broken'))
+        results = self.run_async(asyncio.gather(*[coalescer.run('key', lookup) for i in range(3)],
+            return_exceptions=True))
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(coalescer.pending, {})
+
+@unittest.skipIf(not SUPPORTED, 'aio needs Python 3.5+')
+class TranslateTest(AsyncTestCase):
+    names = {1: 'Madrid', 2: 'Lisbon', 3: 'Paris'}
+
+    def test_materialised_language(self):
+        geonames = FakeGeonames(self.names, {(1, 'es'): 'Madrid', (2, 'es'): 'Lisboa'}, ['es'])
+        names = self.run_async(geonames.translate_many([1, 2, 3], 'es'))
+        self.assertEqual(names, {1: 'Madrid', 2: 'Lisboa', 3: 'Paris'})
+        self.assertEqual(geonames.queries[0], aio.I18N_NAMES_SQL)
+
+    def test_other_languages_use_alternate_names(self):
+        geonames = FakeGeonames(self.names, {(3, 'de'): 'Paris (de)'}, ['es'])
+        names = self.run_async(geonames.translate_many([1, 3], 'de'))
+        self.assertEqual(names, {1: 'Madrid', 3: 'Paris (de)'})
+        self.assertEqual(geonames.queries[0], aio.ALTERNATE_NAMES_SQL)
+
+    def test_no_fallback_query_when_every_name_is_found(self):
+        geonames = FakeGeonames(self.names, {(2, 'pt'): 'Lisboa'})
+        self.assertEqual(self.run_async(geonames.translate(2, 'pt')), 'Lisboa')
+        self.assertEqual(len(geonames.queries), 1)
+
+    def test_unknown_geonames_are_left_out(self):
+        geonames = FakeGeonames(self.names, {})
+        self.assertEqual(self.run_async(geonames.translate_many([1, 99], 'fr')), {1: 'Madrid'})
+
+# Enough of the schema for the lookups which don't need PostGIS
+INTEGRATION_SCHEMA_SQL = (
+    'CREATE TABLE time_zone (id INTEGER PRIMARY KEY, name VARCHAR(30), ' \
+        'gmt_offset NUMERIC(4, 2), dst_offset NUMERIC(4, 2))',
+    'CREATE TABLE geoname (id INTEGER PRIMARY KEY, name VARCHAR(200), ascii_name VARCHAR(200), ' \
+        'latitude NUMERIC(20, 17), longitude NUMERIC(20, 17), fclass CHAR(1), fcode VARCHAR(10), ' \
+        'country_id CHAR(2), cc2 VARCHAR(60), admin1_id INTEGER, admin2_id INTEGER, ' \
+        'admin3_id INTEGER, admin4_id INTEGER, population BIGINT, elevation INTEGER, ' \
+        'gtopo30 INTEGER, timezone_id INTEGER, moddate DATE)',
+    'CREATE TABLE geoname_ancestor (geoname_id INTEGER, ancestor_id INTEGER, depth INTEGER)',
+    'CREATE TABLE geoname_i18n_name (geoname_id INTEGER, language VARCHAR(20), name VARCHAR(200))',
+    'CREATE TABLE alternate_name (id INTEGER PRIMARY KEY, geoname_id INTEGER, ' \
+        'language VARCHAR(20), name VARCHAR(200), preferred BOOLEAN, short BOOLEAN)',
+    "INSERT INTO time_zone VALUES (1, 'Europe/Madrid', 1, 2)",
+    "INSERT INTO geoname (id, name, ascii_name, latitude, longitude, fclass, fcode, country_id, " \
+        "population, timezone_id) VALUES " \
+        "(2510769, 'Spain', 'Spain', 40, -4, 'A', 'PCLI', 'ES', 46505963, 1), " \
+        "(3117735, 'Madrid', 'Madrid', 40.4165, -3.70256, 'P', 'PPLC', 'ES', 3255944, 1)",
+    'INSERT INTO geoname_ancestor VALUES (3117735, 2510769, 1)',
+    "INSERT INTO geoname_i18n_name VALUES (2510769, 'es', 'Espa\u00f1a')",
+    "INSERT INTO alternate_name VALUES (1, 2510769, 'de', 'Spanien', TRUE, FALSE)",
+)
+
+@unittest.skipIf(not SUPPORTED, 'aio needs Python 3.5+')
+@unittest.skipIf(not TEST_DSN, 'GEONAMES_TEST_DSN is not set')
+class PostgreSQLTest(AsyncTestCase):
+    def setUp(self):
+        if asyncpg is None:
+            self.skipTest('asyncpg is not installed')
+        super(PostgreSQLTest, self).setUp()
+        conn = self.run_async(asyncpg.connect(TEST_DSN))
+        try:
+            self.run_async(conn.execute('DROP SCHEMA IF EXISTS %s CASCADE' % TEST_SCHEMA))
+            self.run_async(conn.execute('CREATE SCHEMA %s' % TEST_SCHEMA))
+            self.run_async(conn.execute('SET search_path = %s' % TEST_SCHEMA))
+            for sql in INTEGRATION_SCHEMA_SQL:
+                self.run_async(conn.execute(sql))
+        finally:
+            self.run_async(conn.close())
+        self.geonames = self.run_async(aio.AsyncGeonames.connect(TEST_DSN, pool_size=2,
+            i18n_languages=['es'], server_settings={'search_path': TEST_SCHEMA}))
+
+    def tearDown(self):
+        self.run_async(self.geonames.close())
+        conn = self.run_async(asyncpg.connect(TEST_DSN))
+        self.run_async(conn.execute('DROP SCHEMA IF EXISTS %s CASCADE' % TEST_SCHEMA))
+        self.run_async(conn.close())
+        super(PostgreSQLTest, self).tearDown()
+
+    def test_get_many(self):
+        rows = self.run_async(self.geonames.get_many([3117735, 2510769, 1]))
+        self.assertEqual(sorted(rows), [2510769, 3117735])
+        self.assertEqual(rows[3117735]['name'], 'Madrid')
+        self.assertEqual(sorted(rows[3117735]), sorted(aio.GEONAME_FIELDS))
+
+    def test_translate_many(self):
+        self.assertEqual(self.run_async(self.geonames.translate_many([2510769, 3117735], 'es')),
+            {2510769: 'Espa\u00f1a', 3117735: 'Madrid'})
+        self.assertEqual(self.run_async(self.geonames.translate(2510769, 'de')), 'Spanien')
+
+    def test_hierarchy(self):
+        hierarchy = self.run_async(self.geonames.hierarchy(3117735))
+        self.assertEqual([row['id'] for row in hierarchy], [2510769])
+
+    def test_load_timezones(self):
+        timezones = self.run_async(self.geonames.load_timezones())
+        self.assertEqual(timezones[1]['name'], 'Europe/Madrid')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# geonames-import needs Python 2, Python 3 skips these tests. Run from
+# the application directory with
+#
+#     python2 -m unittest tests.test_import
+#
+# The tests using PostgreSQL are skipped unless GEONAMES_TEST_DSN is set
+# to the postgresql:// URI of a scratch database, they create and drop a
+# geonames_test schema.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if sys.version_info[0] < 3:
+    from imp import load_source
+
+    geonames_import = load_source('geonames_import', os.path.join(APP_DIR, 'geonames-import'))
+
+TEST_DSN = os.environ.get('GEONAMES_TEST_DSN')
+TEST_SCHEMA = 'geonames_test'
+
+ALTERNATE_NAMES = [
+    (1, 3117735, 'es', 'Madrid', 1, 0),
+    (2, 3117735, 'en', 'Madrid', 0, 0),
+    (3, 2267057, 'pt', 'Lisboa', 1, 0),
+    (4, 2267057, 'en', 'Lisbon', 1, 1),
+    (5, 2988507, 'fr', 'Paris', 1, 0),
+    (6, 2988507, 'de', 'Paris', 0, 0),
+]
+
+def write_alternate_names(source):
+    fd = open(os.path.join(source, 'alternateNames.txt'), 'w')
+    for row in ALTERNATE_NAMES:
+        fd.write('%d\t%d\t%s\t%s\t%d\t%d\n' % row)
+    fd.close()
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append(sql)
+
+    def executemany(self, sql, rows):
+        self.conn.statements.append(sql)
+
+    def fetchone(self):
+        return (0,)
+
+class FakeConnection(object):
+    # Records the processes which dropped it, only the one which opened
+    # it should
+    def __init__(self, log):
+        self.pid = os.getpid()
+        self.log = log
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def __del__(self):
+        if os.getpid() != self.pid:
+            fd = open(self.log, 'a')
+            fd.write('%d\n' % os.getpid())
+            fd.close()
+
+if sys.version_info[0] < 3:
+    class FakeImporter(geonames_import.GeonamesImporter):
+        def __init__(self, log, **kwargs):
+            super(FakeImporter, self).__init__(**kwargs)
+            self.log = log
+
+        def get_db_conn(self):
+            self.conn = FakeConnection(self.log)
+            self.cursor = self.conn.cursor()
+
+    class TestImporter(geonames_import.PsycoPg2Importer):
+        def get_db_conn(self):
+            import psycopg2
+            self.conn = psycopg2.connect(TEST_DSN, options='-c search_path=%s' % TEST_SCHEMA)
+            self.cursor = self.conn.cursor()
+
+@unittest.skipIf(sys.version_info[0] >= 3, 'geonames-import needs Python 2')
+class WorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.log = os.path.join(self.source, 'dropped')
+        write_alternate_names(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+
+    def test_workers_leave_the_parent_connection_open(self):
+        importer = FakeImporter(self.log, source=self.source, workers=2)
+        importer.get_db_conn()
+        # Only the importer may hold the connection, like in geonames-import
+        conn_id = id(importer.conn)
+        importer.import_alternate_names()
+        self.assertEqual(id(importer.conn), conn_id)
+        self.assertFalse(os.path.exists(self.log))
+        importer.cursor.execute('SELECT 1')
+        self.assertEqual(importer.conn.statements[-1], 'SELECT 1')
+
+@unittest.skipIf(sys.version_info[0] >= 3, 'geonames-import needs Python 2')
+@unittest.skipIf(not TEST_DSN, 'GEONAMES_TEST_DSN is not set')
+class PostgreSQLWorkersTest(unittest.TestCase):
+    def setUp(self):
+        import psycopg2
+        self.source = tempfile.mkdtemp()
+        write_alternate_names(self.source)
+        conn = psycopg2.connect(TEST_DSN)
+        cursor = conn.cursor()
+        cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % TEST_SCHEMA)
+        cursor.execute('CREATE SCHEMA %s' % TEST_SCHEMA)
+        cursor.execute('CREATE TABLE %s.alternate_name (id INTEGER PRIMARY KEY, ' \
+            'geoname_id INTEGER NOT NULL, language VARCHAR(20) NOT NULL, ' \
+            'name VARCHAR(200) NOT NULL, preferred BOOLEAN NOT NULL, ' \
+            'short BOOLEAN NOT NULL)' % TEST_SCHEMA)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        import psycopg2
+        shutil.rmtree(self.source)
+        conn = psycopg2.connect(TEST_DSN)
+        conn.cursor().execute('DROP SCHEMA IF EXISTS %s CASCADE' % TEST_SCHEMA)
+        conn.commit()
+        conn.close()
+
+    def test_parent_connection_works_after_the_workers(self):
+        importer = TestImporter(source=self.source, workers=2)
+        importer.get_db_conn()
+        importer.import_alternate_names()
+        importer.cursor.execute('SELECT COUNT(*) FROM alternate_name')
+        self.assertEqual(importer.cursor.fetchone()[0], len(ALTERNATE_NAMES))
+        importer.conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# staging.py needs Python 2, Python 3 skips these tests. Run from the
+# application directory with
+#
+#     python2 -m unittest tests.test_staging
+#
+# The statements go to a fake cursor, which answers the queries the
+# deletion makes from a few dicts.
+
+import sys
+import unittest
+
+if sys.version_info[0] < 3:
+    from cStringIO import StringIO
+
+    import staging
+
+class FakeCursor(object):
+    def __init__(self, referenced=(), ancestors=None):
+        self.referenced = set(referenced)
+        self.ancestors = ancestors or {}
+        self.statements = []
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+        ids = params and params[0] or []
+        if sql == staging.REFERENCED_GEONAMES_SQL:
+            self.rows = [(x,) for x in ids if x in self.referenced]
+        elif sql.startswith('SELECT DISTINCT ancestor_id'):
+            self.rows = [(a,) for x in ids for a in self.ancestors.get(x, ())]
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+    def deleted_geonames(self):
+        return [params[0] for sql, params in self.statements
+            if sql.startswith('DELETE FROM geoname WHERE')]
+
+@unittest.skipIf(sys.version_info[0] >= 3, 'staging needs Python 2')
+class DeleteGeonamesTest(unittest.TestCase):
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def delete(self, cursor, ids):
+        return staging.delete_geonames(cursor, ['%d\tname\n' % x for x in ids])
+
+    def test_deletes_every_geoname(self):
+        cursor = FakeCursor(ancestors={ 10: [1, 2] })
+        touched = self.delete(cursor, [10, 11])
+        self.assertEqual(cursor.deleted_geonames(), [[10, 11]])
+        self.assertEqual(touched, set([1, 2, 10, 11]))
+
+    def test_referenced_geonames_are_kept(self):
+        cursor = FakeCursor(referenced=[2510769], ancestors={ 2510769: [6255148], 10: [2510769] })
+        touched = self.delete(cursor, [10, 2510769])
+        self.assertEqual(cursor.deleted_geonames(), [[10]])
+        self.assertEqual(touched, set([10, 2510769]))
+        self.assertTrue('Geoname 2510769' in sys.stdout.getvalue())
+
+    def test_nothing_is_deleted_when_every_geoname_is_referenced(self):
+        cursor = FakeCursor(referenced=[6255148])
+        self.assertEqual(self.delete(cursor, [6255148]), set())
+        self.assertEqual(len(cursor.statements), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# This file is part of Django-Geonames
+# Copyright (c) 2008, Alberto Garcia Hierro
+# See LICENSE file for details
+
+# geonames-update needs Python 2, Python 3 skips these tests. Run from
+# the application directory with
+#
+#     python2 -m unittest tests.test_update
+#
+# Update files are served from a temporary directory, by a local HTTP
+# server standing in for UPDATE_SERVER_URI and as a --mirror.
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import date
+
+if sys.version_info[0] < 3:
+    from imp import load_source
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+    geonames_update = load_source('geonames_update',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'geonames-update'))
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        root = None
+        requests = []
+
+        def translate_path(self, path):
+            QuietHandler.requests.append(path)
+            return os.path.join(self.root, path.lstrip('/'))
+
+        def log_message(self, *args):
+            pass
+
+DAY = date(2024, 1, 2)
+
+@unittest.skipIf(sys.version_info[0] >= 3, 'geonames-update needs Python 2')
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for base_name in geonames_update.UPDATE_FILES:
+            os.mkdir(os.path.join(self.root, base_name))
+            for day in (date(2024, 1, 1), DAY):
+                self.write(base_name, day, '%s %s\n' % (base_name, day.isoformat()))
+        QuietHandler.root = self.root
+        QuietHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        self.server_uri = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def write(self, base_name, day, data):
+        fd = open(os.path.join(self.root, geonames_update.update_file_path(base_name, day)), 'wb')
+        fd.write(data)
+        fd.close()
+
+    def test_fetch_from_server(self):
+        fd = geonames_update.fetch_file('deletes', DAY, self.server_uri)
+        self.assertEqual(fd.read(), 'deletes 2024-01-02\n')
+        fd.close()
+        self.assertEqual(QuietHandler.requests, ['/deletes/deletes-2024-01-02.txt'])
+
+    def test_fetch_from_mirror(self):
+        fd = geonames_update.fetch_file('modifications', DAY, 'http://unused.invalid/', self.root)
+        self.assertEqual(fd.read(), 'modifications 2024-01-02\n')
+        fd.close()
+        self.assertEqual(QuietHandler.requests, [])
+
+    def test_missing_file(self):
+        self.assertRaises(geonames_update.urllib2.HTTPError, geonames_update.fetch_file,
+            'deletes', date(2023, 1, 1), self.server_uri)
+
+    def test_prefetcher_downloads_the_next_days(self):
+        files = geonames_update.Prefetcher(self.server_uri, days=1)
+        files.prefetch(date(2024, 1, 1), date(2024, 1, 3))
+        self.assertEqual(len(files.pending), 2 * len(geonames_update.UPDATE_FILES))
+        for day in (date(2024, 1, 1), DAY):
+            for base_name in geonames_update.UPDATE_FILES:
+                fd = files.get_file_fd(base_name, day)
+                self.assertEqual(fd.read(), '%s %s\n' % (base_name, day.isoformat()))
+                fd.close()
+        self.assertEqual(files.pending, {})
+        self.assertEqual(len(QuietHandler.requests), 2 * len(geonames_update.UPDATE_FILES))
+
+    def test_prefetcher_stops_before_the_last_date(self):
+        files = geonames_update.Prefetcher(self.server_uri, days=5)
+        files.prefetch(DAY, date(2024, 1, 3))
+        self.assertEqual(sorted(set([day for base_name, day in files.pending])), [DAY])
+
+    def test_prefetcher_fetches_what_was_not_prefetched(self):
+        files = geonames_update.Prefetcher(self.server_uri)
+        fd = files.get_file_fd('alternateNamesDeletes', DAY)
+        self.assertEqual(fd.read(), 'alternateNamesDeletes 2024-01-02\n')
+        fd.close()
+
+    def test_prefetcher_exits_when_a_file_is_missing(self):
+        files = geonames_update.Prefetcher(self.server_uri)
+        files.prefetch(date(2023, 1, 1), date(2023, 1, 2))
+        self.assertRaises(SystemExit, files.get_file_fd, 'deletes', date(2023, 1, 1))
+
+if __name__ == '__main__':
+    unittest.main()